@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+"""
+Rendering benchmark for Yandex Transport Timetable CLI.
+Draws synthetic getStopInfo data of different sizes on a fake in-memory curses
+screen of different widths and reports frame time, memory allocations and
+the number of curses calls per frame. No terminal or proxy server needed.
+"""
+
+import argparse
+import curses
+import datetime
+import random
+import statistics
+import time
+import tracemalloc
+from collections import Counter
+
+import timetable_cli
+from timetable_cli import Application, Layout, StopState
+
+ROUTE_TYPES = ['bus', 'minibus', 'tramway', 'trolleybus', 'suburban', 'underground']
+
+
+def make_stop_info(routes_count, timestamp, seed=0):
+    """
+    Generate synthetic Yandex getStopInfo JSON
+    :param routes_count: number of routes at the stop
+    :param timestamp: current time of the data
+    :param seed: random seed, same seed gives same data
+    :return: dictionary, like the one returned by get_stop_info
+    """
+    rnd = random.Random(seed)
+    current_time = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    routes = []
+    for i in range(routes_count):
+        events = []
+        for j in range(rnd.randint(0, 4)):
+            if rnd.random() < 0.7:
+                events.append({'vehicleId': 'vehicle_' + str(i) + '_' + str(j),
+                               'Estimated': {'value': str(int(timestamp + rnd.randint(10, 1800))),
+                                             'text': ''}})
+            else:
+                events.append({'Scheduled': {'value': str(int(timestamp + 600)),
+                                             'text': '{:02d}:{:02d}'.format(rnd.randint(0, 23),
+                                                                            rnd.randint(0, 59))}})
+        # Some routes get long names and terminals, to have running lines on screen
+        name = str(rnd.randint(1, 999)) + rnd.choice(['', '', '', 'к', 'э', ' экспресс-маршрут'])
+        terminals = [{'name': 'Конечная ' + str(k) + ' ' * rnd.randint(0, 1) * 20 + 'улица'}
+                     for k in range(rnd.randint(1, 3))]
+        routes.append({'name': name,
+                       'type': rnd.choice(ROUTE_TYPES),
+                       'EssentialStops': terminals,
+                       'BriefSchedule': {
+                           'Frequency': {'text': str(rnd.randint(2, 40)) + ' мин',
+                                         'value': 60 * rnd.randint(2, 40),
+                                         'begin': {'text': '5:30'},
+                                         'end': {'text': '0:45'}},
+                           'Events': events}})
+    return {'data': {'properties': {
+        'name': 'Синтетическая остановка (' + str(routes_count) + ' маршрутов)',
+        'currentTime': current_time.strftime('%a %b %d %Y %H:%M:%S GMT+0000 (UTC)'),
+        'StopMetaData': {'Transport': routes}}}}
+
+
+class FakeScreen:
+    """
+    In-memory curses screen, counts every call and stops Application.main after
+    the required number of frames.
+    """
+    def __init__(self, height, width, frames=0):
+        self.height = height
+        self.width = width
+        self.frames = frames
+        self.y = 0
+        self.x = 0
+        self.calls = Counter()
+        self.bytes = 0
+        # perf_counter() at every getch(), i.e. at the end of every frame
+        self.frame_ends = []
+
+    def getmaxyx(self):
+        """
+        Size of the screen, same as curses window.getmaxyx()
+        :return: (height, width)
+        """
+        self.calls['getmaxyx'] += 1
+        return self.height, self.width
+
+    def move(self, y, x):
+        """
+        Move the cursor, same as curses window.move()
+        :param y: line
+        :param x: column
+        :return: nothing
+        """
+        self.calls['move'] += 1
+        if y < 0 or x < 0 or y >= self.height or x >= self.width:
+            raise curses.error("move() returned ERR")
+        self.y = y
+        self.x = x
+
+    def addstr(self, *args):
+        """
+        Write a string, same as curses window.addstr(), only its length is counted
+        :param args: (text) or (y, x, text)
+        :return: nothing
+        """
+        self.calls['addstr'] += 1
+        if len(args) == 3:
+            self.y, self.x = args[0], args[1]
+        text = args[-1]
+        self.bytes += len(text.encode('utf-8'))
+        position = self.y * self.width + self.x + len(text)
+        if position >= self.height * self.width:
+            raise curses.error("addstr() returned ERR")
+        self.y, self.x = divmod(position, self.width)
+
+    def clear(self):
+        """
+        Clear the screen, same as curses window.clear()
+        :return: nothing
+        """
+        self.calls['clear'] += 1
+
+    def refresh(self):
+        """
+        Update the terminal, same as curses window.refresh()
+        :return: nothing
+        """
+        self.calls['refresh'] += 1
+
+    def noutrefresh(self):
+        """
+        Mark the screen for update, same as curses window.noutrefresh()
+        :return: nothing
+        """
+        self.calls['noutrefresh'] += 1
+
+    def doupdate(self):
+        """
+        Update the terminal, replaces curses.doupdate() during the run
+        :return: nothing
+        """
+        self.calls['doupdate'] += 1
+
+    def timeout(self, _delay):
+        """
+        Set getch() timeout, same as curses window.timeout()
+        :param _delay: timeout, milliseconds
+        :return: nothing
+        """
+        self.calls['timeout'] += 1
+
+    def nodelay(self, _flag):
+        """
+        Set non-blocking getch(), same as curses window.nodelay()
+        :param _flag: True for non-blocking
+        :return: nothing
+        """
+        self.calls['nodelay'] += 1
+
+    def getch(self):
+        """
+        Get a key, same as curses window.getch(). Marks the end of a frame,
+        returns 'q' after the required number of frames
+        :return: key code, -1 if no key
+        """
+        self.calls['getch'] += 1
+        self.frame_ends.append(time.perf_counter())
+        if len(self.frame_ends) >= self.frames:
+            return ord('q')
+        return -1
+
+
+def make_application(routes_count, timestamp):
+    """
+    Make Application with one stop, showing synthetic data
+    :param routes_count: number of routes at the stop
+    :param timestamp: current time of the data
+    :return: Application
+    """
+    app = Application()
+    stop = StopState(0, 'benchmark', Application.DATA_SOURCE_FILE)
+    stop.snapshot = app.make_snapshot(make_stop_info(routes_count, timestamp),
+                                      Application.DATA_COLLECTION_OK, "", "--:--:--")
+    app.stops.append(stop)
+    return app
+
+
+def run_main(app, height, width, frames):
+    """
+    Run Application.main on fake screen
+    :return: FakeScreen after the run
+    """
+    screen = FakeScreen(height, width, frames)
+    doupdate = curses.doupdate
+    curses.doupdate = screen.doupdate
+    try:
+        app.is_running = True
+        start = time.perf_counter()
+        app.main(screen)
+    finally:
+        curses.doupdate = doupdate
+    screen.frame_ends.insert(0, start)
+    return screen
+
+
+def bench_main(routes_count, height, width, frames):
+    """
+    Benchmark whole frames of Application.main
+    :return: dictionary with results
+    """
+    timestamp = time.time()
+    app = make_application(routes_count, timestamp)
+
+    screen = run_main(app, height, width, frames)
+    frame_times = [b - a for a, b in zip(screen.frame_ends, screen.frame_ends[1:])]
+
+    # Memory is measured in a separate run, tracemalloc slows everything down a lot
+    alloc_frames = max(1, frames // 10)
+    tracemalloc.start()
+    run_main(app, height, width, 1)
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    run_main(app, height, width, alloc_frames)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = sum(count for name, count in screen.calls.items() if name != 'getmaxyx')
+    return {'frame_mean': statistics.mean(frame_times),
+            'frame_p95': sorted(frame_times)[int(len(frame_times) * 0.95)],
+            'peak_kib': (peak - before) / 1024,
+            'leak_kib': (current - before) / 1024,
+            'calls': calls / frames,
+            'getmaxyx': screen.calls['getmaxyx'] / frames,
+            'bytes': screen.bytes / frames}
+
+
+def bench_functions(routes_count, height, width, repeat):
+    """
+    Benchmark separate draw_* functions
+    :return: dictionary, function name: seconds per call
+    """
+    timestamp = time.time()
+    app = make_application(routes_count, timestamp)
+    snapshot = app.stops[0].snapshot
+    rows = [row for _, group in snapshot.view.groups for row in group]
+    screen = FakeScreen(height, width)
+    app.layout = Layout(height, width)
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        app.draw_table_header(screen, 0, snapshot)
+    results['draw_table_header'] = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for route_type, _ in snapshot.view.groups:
+            app.draw_route_type_header(screen, 5, route_type)
+    results['draw_route_type_header'] = \
+        (time.perf_counter() - start) / repeat / max(1, len(snapshot.view.groups))
+
+    start = time.perf_counter()
+    for counter in range(repeat):
+        yandex_now = snapshot.yandex_now()
+        for row in rows:
+            app.draw_transport_data(screen, 10, row, yandex_now, counter)
+    results['draw_transport_data'] = (time.perf_counter() - start) / repeat / max(1, len(rows))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        app.make_snapshot(snapshot.data, Application.DATA_COLLECTION_OK, "", "--:--:--")
+    results['make_snapshot'] = (time.perf_counter() - start) / repeat
+
+    return results
+
+
+def main():
+    """
+    Run the benchmark and print results
+    :return: nothing
+    """
+    parser = argparse.ArgumentParser(description="Rendering benchmark for timetable_cli.py")
+    parser.add_argument("--routes", metavar="N", type=int, nargs='+', default=[10, 100, 1000],
+                        help="numbers of routes at the stop, default is 10 100 1000")
+    parser.add_argument("--widths", metavar="W", type=int, nargs='+',
+                        default=[40, 60, 70, 80, 115],
+                        help="terminal widths, default is 40 60 70 80 115")
+    parser.add_argument("--height", metavar="H", type=int, default=50,
+                        help="terminal height, default is 50")
+    parser.add_argument("--frames", metavar="N", type=int, default=200,
+                        help="frames to draw for every case, default is 200")
+    args = parser.parse_args()
+
+    print("timetable_cli.py", timetable_cli.__version__, "rendering benchmark,",
+          "height", args.height, "lines,", args.frames, "frames per case")
+    print()
+    print("{:>6} {:>6} | {:>10} {:>10} | {:>9} {:>9} | {:>8} {:>9} {:>9}".format(
+        "routes", "width", "frame ms", "p95 ms", "peak KiB", "leak KiB",
+        "calls", "getmaxyx", "bytes"))
+    for routes_count in args.routes:
+        for width in args.widths:
+            result = bench_main(routes_count, args.height, width, args.frames)
+            print("{:>6} {:>6} | {:>10.3f} {:>10.3f} | {:>9.1f} {:>9.1f} | {:>8.1f} {:>9.1f} {:>9.1f}"
+                  .format(routes_count, width,
+                          result['frame_mean'] * 1000, result['frame_p95'] * 1000,
+                          result['peak_kib'], result['leak_kib'],
+                          result['calls'], result['getmaxyx'], result['bytes']))
+
+    print()
+    print("{:>6} {:>6} | {:>24} {:>12}".format("routes", "width", "function", "us per call"))
+    for routes_count in args.routes:
+        width = max(args.widths)
+        repeat = max(1, args.frames // 10)
+        for name, seconds in bench_functions(routes_count, args.height, width, repeat).items():
+            print("{:>6} {:>6} | {:>24} {:>12.1f}".format(routes_count, width, name,
+                                                         seconds * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark for Yandex Transport Timetable CLI.
+Starts timetable_cli.py as a separate process again and again and reports how long it
+takes to print the version, and how long it takes to show the first data of a stop
+(in headless mode) from a JSON file and from a fake Yandex Transport Proxy server.
+Exits with error code if time to first data is over the budget.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark_render import make_stop_info
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timetable_cli.py')
+STOP_URL = 'https://yandex.ru/maps/?masstransit[stopId]=stop__9680781'
+
+
+class FakeProxyServer(threading.Thread):
+    """
+    Yandex Transport Proxy server answering every query right away with synthetic data
+    """
+    def __init__(self, routes_count):
+        super().__init__(daemon=True)
+        self.routes_count = routes_count
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return
+            with connection:
+                try:
+                    query = b''
+                    while not query.endswith(b'\n'):
+                        chunk = connection.recv(4096)
+                        if not chunk:
+                            break
+                        query += chunk
+                    method = query.decode('utf-8').split('?')[0]
+                    answer = {'method': method, 'error': 0, 'expect_more_data': False,
+                              'data': make_stop_info(self.routes_count, time.time())}
+                    connection.sendall(json.dumps(answer).encode('utf-8') + b'\0')
+                except OSError:
+                    pass
+
+    def stop(self):
+        """
+        Stop accepting connections
+        :return: nothing
+        """
+        self.sock.close()
+
+
+def command(module, *args):
+    """
+    Command line to start timetable_cli
+    :param module: start as "python -m timetable_cli" instead of the script
+    :param args: timetable_cli arguments
+    :return: list of strings
+    """
+    if module:
+        return [sys.executable, '-m', 'timetable_cli'] + list(args)
+    return [sys.executable, SCRIPT] + list(args)
+
+
+def time_exit(cmd):
+    """
+    Time from start till the process exits
+    :param cmd: command line
+    :return: seconds
+    """
+    start = time.perf_counter()
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - start
+
+
+def time_first_data(cmd):
+    """
+    Time from start till the first line of headless output, the process is stopped after it
+    :param cmd: command line, headless mode writing to standard output
+    :return: seconds, None if the first line has no data (error or no routes)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    line = process.stdout.readline()
+    elapsed = time.perf_counter() - start
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    process.stdout.close()
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not record.get('ok') or not record.get('routes'):
+        return None
+    return elapsed
+
+
+def run_case(measure, runs):
+    """
+    Run one case several times
+    :param measure: function returning seconds (or None if the run failed)
+    :param runs: number of runs
+    :return: list of seconds of successful runs
+    """
+    # The first run warms up file system caches and writes __pycache__
+    measure()
+    results = [measure() for _ in range(runs)]
+    return [result for result in results if result is not None]
+
+
+def main():
+    """
+    Run the benchmark and print results
+    :return: nothing
+    """
+    parser = argparse.ArgumentParser(description="Startup benchmark for timetable_cli.py")
+    parser.add_argument("--runs", metavar="N", type=int, default=10,
+                        help="runs of every case, default is 10")
+    parser.add_argument("--routes", metavar="N", type=int, default=30,
+                        help="number of routes at the stop, default is 30")
+    parser.add_argument("--budget", metavar="MS", type=float, default=1000,
+                        help="time to first data budget, milliseconds. Exit code is 1 if "
+                             "median time of file or API mode is over it, default is 1000")
+    parser.add_argument("--module", action="store_true", default=False,
+                        help="start as 'python -m timetable_cli' (uses cached bytecode) "
+                             "instead of 'python timetable_cli.py'")
+    args = parser.parse_args()
+
+    # So "python -m timetable_cli" finds the module
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [os.path.dirname(SCRIPT), os.environ.get('PYTHONPATH')]))
+
+    server = FakeProxyServer(args.routes)
+    server.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = os.path.join(tmp, 'stop.json')
+        with open(data_file, 'w', encoding='utf-8') as f:
+            json.dump(make_stop_info(args.routes, time.time()), f, ensure_ascii=False)
+
+        cases = [
+            ('python -c pass', False,
+             lambda: time_exit([sys.executable, '-c', 'pass'])),
+            ('--version', False,
+             lambda: time_exit(command(args.module, '--version'))),
+            ('--help', False,
+             lambda: time_exit(command(args.module, '--help'))),
+            ('file mode', True,
+             lambda: time_first_data(command(args.module, '--headless', data_file))),
+            ('API mode', True,
+             lambda: time_first_data(command(args.module, '--headless',
+                                             '--proxy-host', '127.0.0.1',
+                                             '--proxy-port', str(server.port), STOP_URL))),
+        ]
+
+        print("timetable_cli.py startup benchmark,", args.runs, "runs per case,",
+              args.routes, "routes, budget", args.budget, "ms")
+        print()
+        print("{:>16} | {:>10} {:>10} {:>10} | {:>6}".format(
+            "case", "min ms", "median ms", "max ms", "budget"))
+        over_budget = False
+        for name, budgeted, measure in cases:
+            results = run_case(measure, args.runs)
+            if not results:
+                print("{:>16} | {:>10}".format(name, "FAILED"))
+                over_budget = over_budget or budgeted
+                continue
+            median = statistics.median(results) * 1000
+            verdict = ''
+            if budgeted:
+                verdict = 'OK' if median <= args.budget else 'OVER'
+                over_budget = over_budget or median > args.budget
+            print("{:>16} | {:>10.1f} {:>10.1f} {:>10.1f} | {:>6}".format(
+                name, min(results) * 1000, median, max(results) * 1000, verdict))
+    server.stop()
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
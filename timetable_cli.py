@@ -30,16 +30,41 @@ __status__ = "Beta"
 # pylint: disable = W0702, W0703
 
 import argparse
-from curses import wrapper
+import array
+import bisect
+import functools
+import importlib
+import io
 import json
+import os
+import queue
+import random
+import re
+import socket
+import stat
 import sys
 import time
 import datetime
 import threading
 import signal
-from collections import defaultdict
-from natsort import natsorted
-from yandex_transport_webdriver_api import YandexTransportProxy
+import unicodedata
+from collections import defaultdict, deque, namedtuple
+
+# Heavy modules (curses, natsort, the proxy client, http.server, gzip, ...) are imported
+# where they are used, so --version, --help and file mode start fast.
+
+
+@functools.lru_cache(maxsize=None)
+def import_optional(name):
+    """
+    Import an optional module on first use
+    :param name: module name
+    :return: module, None if it is not installed
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
 
 
 SYMBOLS = {'bus': u"\U0001F68C",
@@ -50,68 +75,2742 @@ SYMBOLS = {'bus': u"\U0001F68C",
            'underground': u"\U0001F687",
            'unknown': u"\u2753"}
 
-class ExecutorThread(threading.Thread):
+def char_width(char):
     """
-    Executor Thread class, will periodically poll Yandex Transport Proxy server.
+    Number of terminal cells taken by a character
+    :param char: character
+    :return: 0, 1 or 2
     """
-    def __init__(self, parent, host, port):
-        super().__init__()
+    code = ord(char)
+    if code < 0x300:
+        return 1
+    if unicodedata.combining(char):
+        return 0
+    if unicodedata.east_asian_width(char) in ('W', 'F'):
+        return 2
+    return 1
+
+class FrameBuffer:
+    """
+    Back buffer for the curses screen. Has the same move/addstr/getmaxyx interface
+    as the curses window, so all draw_* methods work with it. On flush only the cells
+    which differ from the previous frame are written to the real screen.
+    """
+    # Right half of a double width character
+    WIDE_TAIL = ''
+
+    def __init__(self):
+        self.height = 0
+        self.width = 0
+        self.cursor_y = 0
+        self.cursor_x = 0
+        # Nothing can be drawn at this line and below, see set_bottom
+        self.bottom = 0
+        # Current frame, list of rows, every row is a list of cells
+        self.cells = []
+        # Frame currently displayed on the screen
+        self.previous = []
+
+    def getmaxyx(self):
+        """
+        Size of the buffer, same as curses window.getmaxyx()
+        :return: (height, width)
+        """
+        return self.height, self.width
+
+    def resize(self, height, width):
+        """
+        Change buffer size, whole screen will be redrawn on next flush
+        :param height: new height
+        :param width: new width
+        :return: nothing
+        """
+        self.height = height
+        self.width = width
+        self.bottom = height
+        self.previous = []
+
+    def set_bottom(self, bottom):
+        """
+        Forbid moving to the lines starting from this one, to keep them clean
+        :param bottom: first forbidden line, None to allow the whole screen
+        :return: nothing
+        """
+        self.bottom = self.height if bottom is None else min(bottom, self.height)
+
+    def clear(self):
+        """
+        Start a new frame, filled with spaces
+        :return: nothing
+        """
+        self.cells = [[' '] * self.width for _ in range(self.height)]
+        self.cursor_y = 0
+        self.cursor_x = 0
+
+    def move(self, y, x):
+        """
+        Move the cursor, same as curses window.move()
+        :param y: line
+        :param x: column
+        :return: nothing
+        """
+        import curses
+        if y < 0 or x < 0 or y >= self.bottom or x >= self.width:
+            raise curses.error("move() returned ERR")
+        self.cursor_y = y
+        self.cursor_x = x
+
+    def put_char(self, y, x, char, width):
+        """
+        Put a character into the cell, cleaning up halves of overwritten wide characters
+        :param y: line
+        :param x: column
+        :param char: character
+        :param width: character width, 1 or 2
+        :return: nothing
+        """
+        row = self.cells[y]
+        if row[x] == self.WIDE_TAIL and x > 0:
+            row[x - 1] = ' '
+        end = x + width
+        if end < self.width and row[end] == self.WIDE_TAIL:
+            row[end] = ' '
+        row[x] = char
+        if width == 2:
+            row[x + 1] = self.WIDE_TAIL
+
+    def addstr(self, text):
+        """
+        Write a string at the cursor, same as curses window.addstr(), long strings
+        will continue on the next line.
+        :param text: string to write
+        :return: nothing
+        """
+        import curses
+        y = self.cursor_y
+        x = self.cursor_x
+        for char in text:
+            width = char_width(char)
+            if width == 0:
+                continue
+            if x + width > self.width:
+                x = 0
+                y += 1
+            if y >= self.bottom:
+                self.cursor_y, self.cursor_x = self.bottom - 1, self.width - 1
+                raise curses.error("addstr() returned ERR")
+            self.put_char(y, x, char, width)
+            x += width
+            if x >= self.width:
+                if y + 1 >= self.bottom:
+                    self.cursor_y, self.cursor_x = self.bottom - 1, self.width - 1
+                    raise curses.error("addstr() returned ERR")
+                x = 0
+                y += 1
+        self.cursor_y = y
+        self.cursor_x = x
+
+    def changed_span(self, y):
+        """
+        Get changed part of the line compared to the frame on the screen
+        :param y: line
+        :return: (first, last) column of changed part, None if the line is unchanged
+        """
+        row = self.cells[y]
+        if y >= len(self.previous):
+            return 0, self.width - 1
+        old = self.previous[y]
+        if row == old:
+            return None
+        first = 0
+        while row[first] == old[first]:
+            first += 1
+        last = self.width - 1
+        while row[last] == old[last]:
+            last -= 1
+        # Never start or stop in the middle of a wide character
+        if row[first] == self.WIDE_TAIL or old[first] == self.WIDE_TAIL:
+            first -= 1
+        if last + 1 < self.width and \
+                (row[last + 1] == self.WIDE_TAIL or old[last + 1] == self.WIDE_TAIL):
+            last += 1
+        return first, last
+
+    def flush(self, stdscr):
+        """
+        Write changed parts of the frame to the curses screen and update the terminal
+        :param stdscr: curses screen
+        :return: number of bytes written
+        """
+        import curses
+        written = 0
+        if not self.previous:
+            stdscr.clear()
+        for y in range(0, self.height):
+            span = self.changed_span(y)
+            if span is None:
+                continue
+            first, last = span
+            text = ''.join(self.cells[y][first:last + 1])
+            written += len(text.encode('utf-8'))
+            try:
+                stdscr.addstr(y, first, text)
+            except:
+                # Writing to the bottom right corner always "fails"
+                pass
+        try:
+            stdscr.move(self.cursor_y, self.cursor_x)
+        except:
+            pass
+        stdscr.noutrefresh()
+        curses.doupdate()
+        self.previous = self.cells
+        return written
+
+class Layout:
+    """
+    Positions and widths of everything drawn on the screen, for one terminal size.
+    Computed once when the size changes, all draw_* methods take their columns from it.
+    """
+    __slots__ = ('height', 'width',
+                 'show_terminals', 'show_frequency', 'show_hours',
+                 'name_x', 'name_width', 'terminals_x', 'terminals_width',
+                 'hours_x', 'frequency_x', 'arrivals_x',
+                 'title_x', 'title_width', 'titles', 'columns_terminals',
+                 'columns_hours_x', 'columns_frequency_x',
+                 'update_time_x', 'separator',
+                 'metrics_y', 'metrics_width', 'error_y', 'footer_y', 'cursor_x')
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+        # Columns shown at this width
+        self.show_terminals = width >= Application.SCREEN_WIDTH_MINIMAL
+        self.show_frequency = width >= Application.SCREEN_WIDTH_NO_FREQ_AND_HOURS
+        self.show_hours = width >= Application.SCREEN_WIDTH_NO_HOURS
+
+        # Route line: symbol, name, terminals, operating hours, frequency, arrivals
+        self.name_x = 5
+        self.name_width = Application.route_name_width(width)
+        self.terminals_x = 14 + self.name_width - Application.ROUTE_NAME_PREFERRED_WIDTH
+        self.terminals_width = Application.route_terminals_width(width)
+        self.hours_x = width - 34
+        self.frequency_x = width - 19
+        self.arrivals_x = width - 11
+
+        # Route type header: centered title, then names of the columns
+        self.title_x = 3
+        self.title_width = width - 2
+        self.titles = {}
+        self.columns_terminals = "МАРШРУТ".center(self.terminals_width)
+        self.columns_hours_x = width - 33
+        self.columns_frequency_x = width - 20
+
+        # Stop header
+        self.update_time_x = width - 21
+        self.separator = '-' * width
+
+        # Lines at the bottom of the screen
+        self.metrics_y = height - 3
+        self.metrics_width = width - 1
+        self.error_y = height - 2
+        self.footer_y = height - 1
+        self.cursor_x = width - 1
+
+    def route_type_title(self, route_type):
+        """
+        Centered title of the route type header
+        :param route_type: route type, like "bus"
+        :return: string
+        """
+        title = self.titles.get(route_type)
+        if title is None:
+            title = Application.route_type_to_name(route_type).upper().center(self.title_width)
+            self.titles[route_type] = title
+        return title
+
+class Event:
+    """
+    Arrival of a vehicle at the stop, estimated or scheduled
+    """
+    __slots__ = ('vehicle_id', 'estimated', 'scheduled')
+
+    def __init__(self, vehicle_id, estimated, scheduled):
+        # ID of the vehicle, None if unknown
+        self.vehicle_id = vehicle_id
+        # Estimated arrival timestamp in Yandex clock, None if there is no estimation
+        self.estimated = estimated
+        # Scheduled time as text, like "12:30", None if the arrival is estimated
+        self.scheduled = scheduled
+
+class Route:
+    """
+    Route of the stop, parsed from Yandex JSON once per received data snapshot,
+    so the screen never has to look into the JSON.
+    Only the minutes till arrivals are calculated for every frame, from the estimated
+    arrival timestamps, so the countdown keeps going between queries.
+    """
+    __slots__ = ('name', 'type', 'symbol', 'terminals', 'operating_hours', 'frequency',
+                 'begin_minutes', 'end_minutes', 'events', 'eta_stamps', 'scheduled')
+
+    def __init__(self, name, route_type, terminals, operating_hours, frequency,
+                 begin_minutes, end_minutes, events):
+        self.name = name
+        self.type = route_type
+        self.symbol = SYMBOLS.get(route_type, SYMBOLS['unknown'])
+        # Strings to draw
+        self.terminals = terminals
+        self.operating_hours = operating_hours
+        self.frequency = frequency
+        # Operating hours, minutes since midnight, None if unknown
+        self.begin_minutes = begin_minutes
+        self.end_minutes = end_minutes
+        # Tuple of Event
+        self.events = tuple(events)
+        # Estimated arrival timestamps and scheduled times, taken from events
+        self.eta_stamps = tuple(event.estimated for event in events if event.estimated is not None)
+        self.scheduled = tuple(event.scheduled for event in events if event.estimated is None)
+
+    def arrival_times(self, yandex_now):
+        """
+        Calculate nearest arrivals at the given moment
+        :param yandex_now: current time in Yandex clock, from StopSnapshot.yandex_now
+        :return: (list of minutes till estimated arrivals, list of scheduled times,
+                  True if something is arriving now)
+        """
+        if yandex_now is None:
+            return [], [], False
+        estimated, is_now = Application.estimate_minutes(self.eta_stamps, yandex_now)
+        return estimated, self.scheduled, is_now
+
+    def arrivals(self, yandex_now):
+        """
+        Calculate "arrivals" string at the given moment
+        :param yandex_now: current time in Yandex clock, from StopSnapshot.yandex_now
+        :return: (string containing nearest arrivals/schedules, True if something is arriving now)
+        """
+        estimated, scheduled, is_now = self.arrival_times(yandex_now)
+        return Application.arrivals_string(estimated, scheduled), is_now
+
+class StopView:
+    """
+    Everything the screen needs to draw a stop: routes sorted, grouped by route type
+    and formatted. Built by the executor thread each time new data arrives.
+    """
+    # Kinds of screen lines
+    LINE_ROUTE_TYPE = 0
+    LINE_COLUMNS = 1
+    LINE_ROUTE = 2
+    LINE_EMPTY = 3
+
+    def __init__(self, groups=None, nearest_eta=None):
+        # List of (route_type, [Route, ...]) tuples, in display order
+        self.groups = groups if groups is not None else []
+
+        # Screen lines of the stop body, (kind, route type or Route) tuples,
+        # so the screen can go straight to the lines it needs to draw
+        self.lines = []
+        for route_type, rows in self.groups:
+            self.lines.append((self.LINE_ROUTE_TYPE, route_type))
+            self.lines.append((self.LINE_COLUMNS, route_type))
+            for row in rows:
+                self.lines.append((self.LINE_ROUTE, row))
+            self.lines.append((self.LINE_EMPTY, None))
+
+        # Closest estimated arrival timestamp in Yandex clock, None if there are no estimations
+        self.nearest_eta = nearest_eta
+
+    def in_service(self, now_minutes):
+        """
+        Check if any route of the stop operates now
+        :param now_minutes: current time, minutes since midnight
+        :return: False if no route operates now (night time), True otherwise
+        """
+        if self.nearest_eta is not None or not self.groups:
+            return True
+        return any(Application.is_operating(route, now_minutes)
+                   for _, routes in self.groups for route in routes)
+
+class StopSnapshot(namedtuple('StopSnapshot', ['data', 'view', 'yandex_timestamp', 'clock_offset',
+                                               'update_time', 'data_collection_status',
+                                               'display_error', 'stale', 'clock_rate'],
+                              defaults=(False, 1))):
+    """
+    Result of one poll of a stop. Never changed after creation, the executor thread
+    publishes a new one by replacing StopState.snapshot, which is atomic, so the
+    screen can read it without any locks.
+    Stale snapshots are restored from the warm start cache and shown till fresh data arrives.
+    Clock rate is how many Yandex seconds pass in one local second, above 1 for fast replay.
+    """
+    __slots__ = ()
+
+    def yandex_now(self):
+        """
+        Current time in Yandex clock: Yandex currentTime moved forward by the time
+        passed since the data was received (local monotonic clock, times clock rate)
+        :return: timestamp, None if the data has no Yandex timestamp
+        """
+        if self.clock_offset is None:
+            return None
+        return time.monotonic() * self.clock_rate + self.clock_offset
+
+    def nearest_arrival(self):
+        """
+        Time till the closest estimated arrival
+        :return: seconds, None if there are no estimations
+        """
+        if self.view.nearest_eta is None or self.clock_offset is None:
+            return None
+        return self.view.nearest_eta - self.yandex_now()
+
+class StopState:
+    """
+    State of a single public transport stop shown on the timetable.
+    """
+    def __init__(self, index, source_url, data_source):
+        # Position of the stop on the screen
+        self.index = index
+
+        # Data source URL and data source type
+        self.source_url = source_url
+        self.data_source = data_source
+
+        # Signature of the data file loaded last time, for file data source
+        self.file_signature = None
+
+        # When to poll the stop next time (time.monotonic()) and failed polls in a row
+        self.next_poll = 0
+        self.failures = 0
+
+        # Fingerprint of the data received last time, see Application.fingerprint
+        self.fingerprint = None
+
+        # Latest data of the stop, StopSnapshot
+        self.snapshot = StopSnapshot(data=[],
+                                     view=StopView(),
+                                     yandex_timestamp=None,
+                                     clock_offset=None,
+                                     update_time="--:--:--",
+                                     data_collection_status=Application.DATA_COLLECTION_PENDING,
+                                     display_error="")
+
+class HeadlessWriter:
+    """
+    Writes every published snapshot as one compact JSON line (NDJSON), with routes
+    exactly as they would be displayed on the screen. Used instead of curses screen
+    in headless mode.
+    """
+    def __init__(self, parent, stream):
         self.parent = parent
-        self.host = host
-        self.port = port
-        self.proxy = YandexTransportProxy(host, port)
+        self.stream = stream
+        # Snapshots are published from several threads at once
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_record(stop, snapshot):
+        """
+        Make a record for the snapshot
+        :param stop: StopState
+        :param snapshot: StopSnapshot
+        :return: dictionary
+        """
+        try:
+            name = snapshot.data['data']['properties']['name']
+        except:
+            name = None
+        yandex_now = snapshot.yandex_now()
+        routes = []
+        for route_type, rows in snapshot.view.groups:
+            for row in rows:
+                estimated, scheduled, is_now = row.arrival_times(yandex_now)
+                routes.append({'name': row.name,
+                               'type': route_type,
+                               'terminals': row.terminals,
+                               'frequency': row.frequency,
+                               'operating_hours': row.operating_hours.strip(),
+                               'estimated': estimated,
+                               'scheduled': scheduled,
+                               'is_now': is_now})
+        return {'time': time.time(),
+                'stop': stop.source_url,
+                'name': name,
+                'ok': snapshot.data_collection_status == Application.DATA_COLLECTION_OK,
+                'error': snapshot.display_error,
+                'update_time': snapshot.update_time,
+                'yandex_timestamp': snapshot.yandex_timestamp,
+                'stale': snapshot.stale,
+                'routes': routes}
+
+    def __call__(self, stop, snapshot):
+        record = self.make_record(stop, snapshot)
+        if self.parent.vehicle_tracker is not None:
+            record['eta_accuracy'] = self.parent.vehicle_tracker.summary(stop)
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self.lock:
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+            except (BrokenPipeError, ValueError):
+                # Nobody reads the output anymore
+                self.parent.is_running = False
+
+class WarmCache:
+    """
+    Keeps the last good data of every stop in a file, so after restart the timetable
+    shows it right away (marked as stale) instead of an empty screen, while fresh data
+    is being collected. Used as snapshot listener.
+    """
+    # How often to save the file, seconds
+    SAVE_INTERVAL = 60
+
+    def __init__(self, parent, filename):
+        self.parent = parent
+        self.filename = filename
+        self.lock = threading.Lock()
+        # Source URL: {'time': time.time() when received, 'data': Yandex JSON}
+        self.entries = {}
+        self.dirty = False
+        self.save_time = time.monotonic()
+        # Last error of saving the file, empty if none
+        self.error = ""
+
+    def load(self):
+        """
+        Load the file and publish stale snapshots for the stops found there
+        :return: number of stops restored
+        """
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            print("Exception (warm cache load): " + str(e), file=sys.stderr)
+            return 0
+
+        restored = 0
+        for stop in self.parent.stops:
+            entry = entries.get(stop.source_url)
+            if entry is None or stop.data_source == Application.DATA_SOURCE_FILE:
+                continue
+            try:
+                data = self.drop_past_arrivals(entry['data'], entry['time'])
+                update_time = datetime.datetime.fromtimestamp(entry['time']).strftime('%H:%M:%S')
+                snapshot = self.parent.make_snapshot(data, Application.DATA_COLLECTION_OK, "",
+                                                     update_time, entry['time'])
+            except Exception as e:
+                print("Exception (warm cache load): " + str(e), file=sys.stderr)
+                continue
+            if snapshot.data_collection_status != Application.DATA_COLLECTION_OK:
+                continue
+            with self.lock:
+                self.entries[stop.source_url] = entry
+            self.parent.publish(stop, snapshot._replace(stale=True))
+            restored += 1
+        return restored
+
+    @staticmethod
+    def drop_past_arrivals(data, received):
+        """
+        Remove estimated arrivals which have already happened from old data
+        :param data: Yandex JSON from getStopInfo, not modified
+        :param received: time.time() when data was received
+        :return: Yandex JSON without past arrivals
+        """
+        yandex_timestamp, _ = Application.get_yandex_timestamp(data)
+        routes = Application.get_routes(data)
+        if yandex_timestamp is None or routes is None:
+            return data
+        yandex_now = yandex_timestamp + max(0, time.time() - received)
+
+        def is_future(event):
+            try:
+                return float(event['Estimated']['value']) > yandex_now
+            except (KeyError, TypeError, ValueError):
+                return True
+
+        result_routes = []
+        for route in routes:
+            schedule = route.get('BriefSchedule')
+            if isinstance(schedule, dict) and isinstance(schedule.get('Events'), list):
+                schedule = dict(schedule, Events=[event for event in schedule['Events']
+                                                  if is_future(event)])
+                route = dict(route, BriefSchedule=schedule)
+            result_routes.append(route)
+        properties = data['data']['properties']
+        return {'data': dict(data['data'], properties=dict(
+            properties, StopMetaData=dict(properties['StopMetaData'], Transport=result_routes)))}
+
+    def save(self):
+        """
+        Save the file if anything has changed, replacing it at once so it's never half-written
+        :return: nothing
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            text = json.dumps(self.entries, ensure_ascii=False, separators=(',', ':'))
+            self.dirty = False
+            self.save_time = time.monotonic()
+        temp_filename = self.filename + '.tmp'
+        try:
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temp_filename, self.filename)
+        except Exception as e:
+            error = "Exception (warm cache save): " + str(e)
+            # Printing only once, and never over the curses screen
+            if self.error != error and not self.parent.screen_active:
+                print(error, file=sys.stderr)
+            self.error = error
+            # Trying again next time
+            with self.lock:
+                self.dirty = True
+            return
+        self.error = ""
+
+    def __call__(self, stop, snapshot):
+        if snapshot.data_collection_status != Application.DATA_COLLECTION_OK or \
+                snapshot.stale or stop.data_source == Application.DATA_SOURCE_FILE:
+            return
+        with self.lock:
+            self.entries[stop.source_url] = {'time': time.time(), 'data': snapshot.data}
+            self.dirty = True
+            save_now = time.monotonic() - self.save_time >= self.SAVE_INTERVAL
+        if save_now:
+            self.save()
+
+class VehicleTrack:
+    """
+    One vehicle on its way to the stop, followed across consecutive snapshots
+    """
+    __slots__ = ('first_seen', 'first_eta', 'last_seen', 'last_eta', 'etas', 'partial')
+
+    def __init__(self, seen, eta, partial, max_etas):
+        # Yandex time of the first and the last snapshot showing the vehicle,
+        # estimated arrival in these snapshots
+        self.first_seen = seen
+        self.first_eta = eta
+        self.last_seen = seen
+        self.last_eta = eta
+        # Estimated arrivals shown to passengers, the latest ones
+        self.etas = deque((eta,), maxlen=max_etas)
+        # True if the vehicle could be shown before it was first seen
+        # (first snapshot of the stop, or first one after a break in data)
+        self.partial = partial
+
+    def update(self, seen, eta):
+        """
+        Add estimated arrival from a new snapshot
+        :param seen: Yandex time of the snapshot
+        :param eta: estimated arrival timestamp
+        :return: nothing
+        """
+        self.last_seen = seen
+        self.last_eta = eta
+        self.etas.append(eta)
+
+# What happened to a vehicle when it disappeared from the stop:
+# kind is 'arrived', 'missed' (arrived, but shown too late) or 'phantom' (never came),
+# drift and mean error of its estimated arrivals are in seconds, None if unknown
+TrackOutcome = namedtuple('TrackOutcome', ['kind', 'drift', 'error'])
+
+class VehicleTracker:
+    """
+    Follows vehicles across consecutive snapshots of every stop, to measure quality of
+    the estimated arrivals shown to passengers. A vehicle disappeared from the stop close
+    to its estimated arrival has arrived, the last estimation is taken as the arrival time.
+    A vehicle disappeared long before it is a phantom. Work per snapshot is proportional
+    to the number of its events, only the latest outcomes are kept for every stop.
+    Used as snapshot listener.
+    """
+    # Vehicle disappeared with estimated arrival closer than this has arrived, seconds
+    ARRIVAL_WINDOW = 180
+
+    # Arrival shown to passengers for less time than this is missed, seconds
+    MIN_NOTICE = 120
+
+    # Vehicle not seen for this long, or with estimated arrival moved by this much
+    # at once, is on its next trip (same as ArchiveAnalyzer.TRIP_GAP), seconds
+    TRIP_GAP = 600
+
+    # Estimated arrivals kept for every vehicle
+    MAX_ETAS = 60
+
+    # Outcomes kept for every stop
+    WINDOW_SIZE = 100
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        # Snapshots are published from several threads at once
+        self.lock = threading.Lock()
+        # Stop index: {(route name, vehicle ID): VehicleTrack}
+        self.tracks = defaultdict(dict)
+        # Stop index: Yandex time of its last snapshot
+        self.last_seen = {}
+        # Stop index: deque of the latest TrackOutcome
+        self.outcomes = defaultdict(lambda: deque(maxlen=self.WINDOW_SIZE))
+
+    def __call__(self, stop, snapshot):
+        if snapshot.stale or snapshot.yandex_timestamp is None or \
+                snapshot.data_collection_status != Application.DATA_COLLECTION_OK:
+            return
+        now = snapshot.yandex_timestamp
+        with self.lock:
+            last_seen = self.last_seen.get(stop.index)
+            if last_seen is not None and now <= last_seen:
+                # Same data again, or older data
+                return
+            self.last_seen[stop.index] = now
+            partial = last_seen is None or now - last_seen > self.TRIP_GAP
+            tracks = self.tracks[stop.index]
+            seen = set()
+            for _, rows in snapshot.view.groups:
+                for row in rows:
+                    for event in row.events:
+                        if event.vehicle_id is None or event.estimated is None:
+                            continue
+                        key = (row.name, event.vehicle_id)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        track = tracks.get(key)
+                        if track is not None and \
+                                (now - track.last_seen > self.TRIP_GAP or
+                                 abs(event.estimated - track.last_eta) > self.TRIP_GAP):
+                            self.finish(stop, track, now)
+                            track = None
+                        if track is None:
+                            tracks[key] = VehicleTrack(now, event.estimated, partial, self.MAX_ETAS)
+                        else:
+                            track.update(now, event.estimated)
+            for key in [key for key in tracks if key not in seen]:
+                self.finish(stop, tracks.pop(key), now)
+
+    def touch(self, stop, yandex_timestamp):
+        """
+        Take a poll which returned the same routes and arrivals as the last snapshot of
+        the stop. Such snapshots are published without notifying the listeners, but every
+        vehicle was still shown, with the same estimated arrival.
+        :param stop: StopState
+        :param yandex_timestamp: current time in Yandex clock of the poll
+        :return: nothing
+        """
+        if yandex_timestamp is None:
+            return
+        with self.lock:
+            last_seen = self.last_seen.get(stop.index)
+            if last_seen is None or yandex_timestamp <= last_seen:
+                return
+            self.last_seen[stop.index] = yandex_timestamp
+            for track in self.tracks[stop.index].values():
+                track.update(yandex_timestamp, track.last_eta)
+
+    def forget(self, stop):
+        """
+        Drop vehicles and outcomes of the stop which is not polled anymore
+        :param stop: StopState
+        :return: nothing
+        """
+        with self.lock:
+            self.tracks.pop(stop.index, None)
+            self.last_seen.pop(stop.index, None)
+            self.outcomes.pop(stop.index, None)
+
+    def finish(self, stop, track, now):
+        """
+        Decide what happened to the vehicle which is not shown anymore
+        :param stop: StopState
+        :param track: VehicleTrack
+        :param now: Yandex time of the snapshot without the vehicle
+        :return: nothing
+        """
+        if now - track.last_seen > self.TRIP_GAP:
+            # No data for a long time, the vehicle could go anywhere
+            return
+        if track.last_eta - now > self.ARRIVAL_WINDOW:
+            self.metrics.inc('phantom_arrivals_total')
+            self.outcomes[stop.index].append(TrackOutcome('phantom', None, None))
+            return
+
+        arrival = track.last_eta
+        errors = [abs(eta - arrival) for eta in track.etas]
+        for error in errors:
+            self.metrics.observe('eta_error_seconds', error)
+        self.metrics.inc('arrivals_total')
+        if track.partial:
+            # When the vehicle was shown first is unknown
+            self.outcomes[stop.index].append(
+                TrackOutcome('arrived', None, sum(errors) / len(errors)))
+            return
+        drift = track.last_eta - track.first_eta
+        self.metrics.observe('eta_drift_seconds', abs(drift))
+        kind = 'arrived'
+        if arrival - track.first_seen < self.MIN_NOTICE:
+            kind = 'missed'
+            self.metrics.inc('missed_arrivals_total')
+        self.outcomes[stop.index].append(TrackOutcome(kind, drift, sum(errors) / len(errors)))
+
+    @staticmethod
+    def quantile(values, q):
+        """
+        Quantile of the values
+        :param values: list of numbers
+        :param q: quantile, 0.5 for median
+        :return: value, None if there are no values
+        """
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def summary(self, stop):
+        """
+        Quality of estimated arrivals at the stop, over the latest outcomes
+        :param stop: StopState
+        :return: dictionary with 'arrivals', 'missed', 'phantom' (counts), 'drift_p50',
+                 'drift_p90' (how far estimated arrival moved before the arrival, positive
+                 if later than first estimated), 'error_p50', 'error_p90' (mean error of
+                 estimated arrivals shown for one vehicle), seconds, None if unknown
+        """
+        with self.lock:
+            outcomes = list(self.outcomes.get(stop.index, ()))
+        drifts = [outcome.drift for outcome in outcomes if outcome.drift is not None]
+        errors = [outcome.error for outcome in outcomes if outcome.error is not None]
+        return {'arrivals': sum(1 for outcome in outcomes if outcome.kind != 'phantom'),
+                'missed': sum(1 for outcome in outcomes if outcome.kind == 'missed'),
+                'phantom': sum(1 for outcome in outcomes if outcome.kind == 'phantom'),
+                'drift_p50': self.quantile(drifts, 0.5),
+                'drift_p90': self.quantile(drifts, 0.9),
+                'error_p50': self.quantile(errors, 0.5),
+                'error_p90': self.quantile(errors, 0.9)}
+
+class ArchiveWriter(threading.Thread):
+    """
+    Archive Writer Thread class, stores data from Yandex to log_dir in background,
+    so slow disks never delay polling.
+    Every record is a compact JSON line, compressed as a separate gzip member and
+    appended to the current segment file (so "zcat segment | jq" works, and a segment
+    stays readable even if the program was killed while writing it).
+    Segments are rotated by size or by age. Next to every segment there is an index
+    file with time, offset and stop of every record, used by ArchiveReader.
+    """
+    SEGMENT_PREFIX = 'archive-'
+    SEGMENT_SUFFIX = '.ndjson.gz'
+    INDEX_SUFFIX = '.idx'
+
+    def __init__(self, log_dir, max_bytes, max_age, queue_size, metrics):
+        super().__init__()
+        self.log_dir = log_dir
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        # Current segment file, its index, size and creation time
+        self.segment = None
+        self.index = None
+        self.segment_size = 0
+        self.segment_time = 0
+
+        # Records not stored because the queue was full
+        self.dropped = 0
+
+        # Last error, empty if everything is OK
+        self.error = ""
+
+    def put(self, source_url, data):
+        """
+        Queue data from Yandex to be stored, never blocks
+        :param source_url: URL of the data source
+        :param data: Yandex JSON, must not be changed after this call,
+                     None if the data is the same as last time (stored as "unchanged" marker)
+        :return: True if queued, False if the queue is full and data was dropped
+        """
+        if data is None:
+            record = {'time': time.time(), 'stop': source_url, 'unchanged': True}
+        else:
+            record = {'time': time.time(), 'stop': source_url, 'data': data}
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.metrics.inc('archive_dropped_total')
+            self.error = "Archive queue is full, " + str(self.dropped) + " records dropped"
+            return False
+        return True
+
+    def stop(self):
+        """
+        Store everything queued so far and finish the thread
+        :return: nothing
+        """
+        self.queue.put(None)
+
+    def open_segment(self, timestamp):
+        """
+        Close current segment and start a new one
+        :param timestamp: time of the first record in the segment
+        :return: nothing
+        """
+        self.close_segment()
+        name = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(
+            '%Y%m%d-%H%M%S-%f')
+        filename = os.path.join(self.log_dir, self.SEGMENT_PREFIX + name)
+        self.segment = open(filename + self.SEGMENT_SUFFIX, 'ab')
+        self.index = open(filename + self.INDEX_SUFFIX, 'a', encoding='utf-8')
+        self.segment_size = self.segment.tell()
+        self.segment_time = timestamp
+
+    def close_segment(self):
+        """
+        Close current segment, if any
+        :return: nothing
+        """
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def write(self, record):
+        """
+        Append one record to the archive, rotating the segment if needed
+        :param record: dictionary with 'time', 'stop' and 'data' (or 'unchanged')
+        :return: nothing
+        """
+        if self.segment is None or \
+                self.segment_size >= self.max_bytes or \
+                record['time'] - self.segment_time >= self.max_age:
+            self.open_segment(record['time'])
+
+        import gzip
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        member = gzip.compress(line.encode('utf-8'))
+        self.segment.write(member)
+        self.segment.flush()
+        # Index line is written only after the record itself is in the segment
+        self.index.write(str(record['time']) + '\t' + str(self.segment_size) + '\t' +
+                         record['stop'] + '\n')
+        self.index.flush()
+        self.segment_size += len(member)
+        self.metrics.inc('archive_bytes_total', len(member))
 
     def run(self):
-        while self.parent.is_running:
-            self.parent.display_error = ""
-            json_data = []
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                start_time = time.perf_counter()
+                self.write(record)
+                self.metrics.observe('archive_write_seconds', time.perf_counter() - start_time)
+                # Writing works again, the error is not shown anymore
+                if self.error != "":
+                    self.error = ""
+                    self.dropped = 0
+            except Exception as e:
+                self.error = "Exception (archive write): " + str(e)
+                self.close_segment()
+        self.close_segment()
+        print("ARCHIVE WRITER TERMINATED!")
 
-            if self.parent.data_source == self.parent.DATA_SOURCE_FILE:
+class ArchiveReader:
+    """
+    Reader of the log_dir archive made by ArchiveWriter. Segment names and index files
+    are used to find records by time, nothing before the requested time is read.
+    """
+    def __init__(self, log_dir, fields=None):
+        self.log_dir = log_dir
+        # Fields of the records to read, None for everything
+        self.fields = fields
+        # List of segment files and their start times, sorted by time
+        self.segments = []
+        for filename in os.listdir(log_dir):
+            if filename.startswith(ArchiveWriter.SEGMENT_PREFIX) and \
+                    filename.endswith(ArchiveWriter.SEGMENT_SUFFIX):
+                self.segments.append((self.segment_start_time(filename),
+                                      os.path.join(log_dir, filename)))
+        self.segments.sort()
+        self.start_times = [segment[0] for segment in self.segments]
+
+    @staticmethod
+    def segment_start_time(filename):
+        """
+        Get start time of the segment from its name
+        :param filename: segment file name
+        :return: timestamp
+        """
+        name = filename[len(ArchiveWriter.SEGMENT_PREFIX):-len(ArchiveWriter.SEGMENT_SUFFIX)]
+        return datetime.datetime.strptime(name, '%Y%m%d-%H%M%S-%f').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+    @staticmethod
+    def scan_index(path):
+        """
+        Build index of the segment by decompressing it, used if index file is missing
+        :param path: segment file path
+        :return: list of (time, offset, stop) tuples
+        """
+        import zlib
+        index = []
+        with open(path, 'rb') as f:
+            raw = f.read()
+        offset = 0
+        while offset < len(raw):
+            decompressor = zlib.decompressobj(wbits=31)
+            line = decompressor.decompress(raw[offset:])
+            try:
+                record = json.loads(line.decode('utf-8'))
+                index.append((record['time'], offset, record['stop']))
+            except Exception as e:
+                print("Exception (scan_index): " + path + ": " + str(e), file=sys.stderr)
+            if not decompressor.eof:
+                break
+            offset = len(raw) - len(decompressor.unused_data)
+        return index
+
+    def load_index(self, path):
+        """
+        Load index of the segment
+        :param path: segment file path
+        :return: list of (time, offset, stop) tuples, sorted by time
+        """
+        index_path = path[:-len(ArchiveWriter.SEGMENT_SUFFIX)] + ArchiveWriter.INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            return self.scan_index(path)
+        index = []
+        with open(index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t', 2)
+                if len(fields) == 3:
+                    index.append((float(fields[0]), int(fields[1]), fields[2]))
+        return index
+
+    @staticmethod
+    def read_record(f, offset, length, fields=None):
+        """
+        Read one record from the segment
+        :param f: segment file, opened in binary mode
+        :param offset: offset of the record
+        :param length: size of compressed record, -1 to read till the end of file
+        :param fields: fields of the record to keep (see Application.prune_data),
+                       None to keep everything
+        :return: dictionary with 'time', 'stop' and 'data' ('unchanged' instead of 'data'
+                 if the data was the same as in the previous record of the stop)
+        """
+        import gzip
+        import zlib
+        f.seek(offset)
+        if fields is not None:
+            return Application.parse_json(gzip.GzipFile(fileobj=io.BytesIO(f.read(length))),
+                                          fields)
+        decompressor = zlib.decompressobj(wbits=31)
+        return json.loads(decompressor.decompress(f.read(length)).decode('utf-8'))
+
+    def records(self, start_time=None, stops=None):
+        """
+        Iterate over archived records in time order
+        :param start_time: skip records older than this timestamp, None to start from the beginning
+        :param stops: set of source URLs to read, None to read all of them
+        :return: generator of dictionaries with 'time', 'stop' and 'data' (or 'unchanged')
+        """
+        for path in self.segment_paths(start_time):
+            yield from self.segment_records(path, start_time, stops)
+
+    def segment_paths(self, start_time=None, end_time=None):
+        """
+        Segments having records of the time range
+        :param start_time: beginning of the range, None for the beginning of the archive
+        :param end_time: end of the range, None for the end of the archive
+        :return: list of segment file paths, sorted by time
+        """
+        first = 0
+        if start_time is not None:
+            first = max(0, bisect.bisect_right(self.start_times, start_time) - 1)
+        last = len(self.segments)
+        if end_time is not None:
+            last = bisect.bisect_right(self.start_times, end_time)
+        return [path for _, path in self.segments[first:last]]
+
+    def segment_records(self, path, start_time=None, stops=None):
+        """
+        Iterate over archived records of one segment in time order
+        :param path: segment file path
+        :param start_time: skip records older than this timestamp, None to start from the beginning
+        :param stops: set of source URLs to read, None to read all of them
+        :return: generator of dictionaries with 'time', 'stop' and 'data' (or 'unchanged')
+        """
+        index = self.load_index(path)
+        position = 0
+        if start_time is not None:
+            position = bisect.bisect_left([entry[0] for entry in index], start_time)
+        with open(path, 'rb') as f:
+            for i in range(position, len(index)):
+                record_time, offset, stop = index[i]
+                if stops is not None and stop not in stops:
+                    continue
+                length = index[i + 1][1] - offset if i + 1 < len(index) else -1
                 try:
-                    json_data = self.parent.load_data_from_file(self.parent.source_url)
-                    self.parent.data_collection_status = self.parent.DATA_COLLECTION_OK
+                    yield self.read_record(f, offset, length, self.fields)
                 except Exception as e:
-                    self.parent.display_error = "Exception (data load from file)" + str(e)
-                    self.parent.data_collection_status = self.parent.DATA_COLLECTION_FAILED
+                    print("Exception (read_record): " + path + " at " +
+                          str(record_time) + ": " + str(e), file=sys.stderr)
+
+class ReplayThread(threading.Thread):
+    """
+    Replay Thread class, plays data from the log_dir archive instead of polling
+    Yandex Transport Proxy, at real or accelerated speed.
+    """
+    def __init__(self, parent, log_dir, speed, start_time):
+        super().__init__()
+        self.parent = parent
+        self.reader = ArchiveReader(log_dir, parent.ARCHIVE_RECORD_FIELDS)
+        self.speed = speed
+        self.start_time = start_time
+
+    def get_stop(self, source_url, stops):
+        """
+        Get the stop to publish data to, new stops are added to the screen if
+        no stops were requested explicitly
+        :param source_url: URL of the data source from the archive
+        :param stops: dictionary, source URL: StopState
+        :return: StopState, None if this stop should not be displayed
+        """
+        if source_url in stops:
+            return stops[source_url]
+        if self.parent.replay_filter:
+            return None
+        stop = StopState(len(self.parent.stops), source_url, self.parent.DATA_SOURCE_REPLAY)
+        stops[source_url] = stop
+        self.parent.stops.append(stop)
+        return stop
+
+    def run(self):
+        stops = {stop.source_url: stop for stop in self.parent.stops}
+        wanted = set(stops) if self.parent.replay_filter else None
+
+        start_wall = time.monotonic()
+        first_time = None
+        clock_rate = self.speed if self.speed > 0 else 1
+        # Stop index: archive time of the last data of the stop
+        data_times = {}
+        for record in self.reader.records(self.start_time, wanted):
+            if not self.parent.is_running:
+                break
+            if first_time is None:
+                first_time = record['time']
+
+            # Waiting till it's time to show this record
+            if self.speed > 0:
+                due = start_wall + (record['time'] - first_time) / self.speed
+                while self.parent.is_running and time.monotonic() < due:
+                    time.sleep(min(0.1, due - time.monotonic()))
+
+            stop = self.get_stop(record['stop'], stops)
+            if stop is None:
+                continue
+            if 'data' not in record:
+                # Unchanged data markers show nothing new, but vehicles were still shown
+                tracker = self.parent.vehicle_tracker
+                snapshot = stop.snapshot
+                if tracker is not None and stop.index in data_times and \
+                        snapshot.yandex_timestamp is not None:
+                    tracker.touch(stop, snapshot.yandex_timestamp +
+                                  record['time'] - data_times[stop.index])
+                continue
+            data_times[stop.index] = record['time']
+            update_time = datetime.datetime.fromtimestamp(record['time']).strftime('%H:%M:%S')
+            # Arrivals count down as fast as the archive is played
+            self.parent.publish(stop, self.parent.make_snapshot(record['data'],
+                                                                self.parent.DATA_COLLECTION_OK,
+                                                                "", update_time, None,
+                                                                clock_rate))
+
+        print("REPLAY THREAD TERMINATED!")
+
+def parse_time(text):
+    """
+    Parse time given in command line
+    :param text: 'YYYY-MM-DD HH:MM:SS' (local time) or unix timestamp
+    :return: timestamp, None if the time is wrong
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
+class ArchiveAnalyzer:
+    """
+    Offline analytics over the log_dir archive. The archive is read once into columnar
+    NumPy arrays, one row per observed event or route. Headways, gaps against
+    BriefSchedule.Frequency and availability of service are then computed with
+    array operations, not per record.
+    """
+    # The same vehicle not seen for this long, or with its estimated arrival moved
+    # by this much, is on its next trip (seconds)
+    TRIP_GAP = 600
+
+    # Longer headways are breaks in service (like night) or in the archive (seconds)
+    MAX_HEADWAY = 3 * 3600
+
+    # Headway longer than this many announced intervals is a gap in service
+    GAP_FACTOR = 1.5
+
+    # Percentiles of headway distribution
+    PERCENTILES = (10, 50, 90)
+
+    def __init__(self, numpy):
+        self.np = numpy
+        # Source URLs and names of the stops, indexed by stop code
+        self.stop_urls = []
+        self.stop_names = []
+        self.stop_codes = {}
+        # (name, type) of the routes, indexed by route code
+        self.route_keys = []
+        self.route_codes = {}
+        # Vehicle IDs, indexed by vehicle code
+        self.vehicle_ids = []
+        self.vehicle_codes = {}
+        # Data blocks (archived JSONs) and route rows read so far, block of the last
+        # data of every stop
+        self.blocks = 0
+        self.route_rows = 0
+        self.last_blocks = {}
+        # Columns, one row per snapshot (archive record): time, stop
+        self.snapshots = {}
+        # Columns, one row per event of a route in a snapshot:
+        # snapshot, stop, time, route, vehicle, estimated, scheduled, frequency
+        self.events = {}
+        # Columns, one row per route in a snapshot: snapshot, stop, time, route, frequency, live
+        self.routes = {}
+
+    @staticmethod
+    def add_block(data, block, part):
+        """
+        Append routes and events of one archived getStopInfo JSON to the columns.
+        This runs for every event in the archive, so it does as little as possible.
+        :param data: Yandex JSON from getStopInfo
+        :param block: number of this JSON in the segment
+        :param part: segment being read, see read_segment
+        :return: nothing
+        """
+        nan = float('nan')
+        route_codes = part['route_codes']
+        vehicle_codes = part['vehicle_codes']
+        columns = part['columns']
+        event_row = columns['event_row'].append
+        event_vehicle = columns['event_vehicle'].append
+        event_estimated = columns['event_estimated'].append
+        event_scheduled = columns['event_scheduled'].append
+        for route in Application.get_routes(data) or []:
+            key = (str(route.get('name', "????")), str(route.get('type', 'unknown')))
+            route_code = route_codes.get(key)
+            if route_code is None:
+                route_code = route_codes[key] = len(route_codes)
+            row = len(columns['route_block'])
+            schedule = route.get('BriefSchedule', {})
+            try:
+                frequency = float(schedule['Frequency']['value'])
+            except:
+                frequency = nan
+            columns['route_block'].append(block)
+            columns['route_route'].append(route_code)
+            columns['route_frequency'].append(frequency)
+
+            for event in schedule.get('Events', ()):
+                estimated = event.get('Estimated')
+                scheduled = event.get('Scheduled')
+                try:
+                    estimated = float(estimated['value']) if estimated else nan
+                    scheduled = float(scheduled['value']) if scheduled else nan
+                except:
+                    continue
+                vehicle_code = -1
+                vehicle_id = event.get('vehicleId')
+                if vehicle_id is not None:
+                    vehicle_code = vehicle_codes.get(vehicle_id)
+                    if vehicle_code is None:
+                        vehicle_code = vehicle_codes[vehicle_id] = len(vehicle_codes)
+                event_row(row)
+                event_vehicle(vehicle_code)
+                event_estimated(estimated)
+                event_scheduled(scheduled)
+
+    @staticmethod
+    def read_segment(reader, path, start_time=None, end_time=None, stops=None):
+        """
+        Read one archive segment into columns, may run in a separate process.
+        Codes of stops, routes and vehicles are local to the segment.
+        :param reader: ArchiveReader
+        :param path: segment file path
+        :param start_time: skip records older than this timestamp, None to read from the beginning
+        :param end_time: stop at records newer than this timestamp, None to read till the end
+        :param stops: set of source URLs to read, None to read all of them
+        :return: dictionary with 'stop_codes' (URL: code), 'stop_names', 'route_codes'
+                 ((name, type): code), 'vehicle_codes' (vehicle ID: code), 'blocks',
+                 'last_blocks' (stop code: block of its last data) and 'columns' (array.array).
+                 Snapshots of unchanged data markers have block -1 if the data is in
+                 the previous segments.
+        """
+        part = {'stop_codes': {}, 'stop_names': {}, 'route_codes': {}, 'vehicle_codes': {},
+                'blocks': 0, 'last_blocks': {},
+                'columns': {name: array.array(typecode) for name, typecode in (
+                    ('snapshot_time', 'd'), ('snapshot_stop', 'l'), ('snapshot_block', 'l'),
+                    ('route_block', 'l'), ('route_route', 'l'), ('route_frequency', 'd'),
+                    ('event_row', 'l'), ('event_vehicle', 'l'),
+                    ('event_estimated', 'd'), ('event_scheduled', 'd'))}}
+        stop_codes = part['stop_codes']
+        last_blocks = part['last_blocks']
+        columns = part['columns']
+        blocks = 0
+        for record in reader.segment_records(path, start_time, stops):
+            if end_time is not None and record['time'] > end_time:
+                break
+            stop_code = stop_codes.get(record['stop'])
+            if stop_code is None:
+                stop_code = stop_codes[record['stop']] = len(stop_codes)
+            if 'data' in record:
+                block = last_blocks[stop_code] = blocks
+                blocks += 1
+                ArchiveAnalyzer.add_block(record['data'], block, part)
+                try:
+                    part['stop_names'][stop_code] = record['data']['data']['properties']['name']
+                except:
+                    pass
             else:
+                block = last_blocks.get(stop_code, -1)
+            columns['snapshot_time'].append(record['time'])
+            columns['snapshot_stop'].append(stop_code)
+            columns['snapshot_block'].append(block)
+        part['blocks'] = blocks
+        return part
+
+    @staticmethod
+    def seed_time(reader, start_time, end_time=None, stops=None):
+        """
+        Find where to start reading, so unchanged data markers at the beginning of the
+        time range have the data they repeat: the earliest of the last data records
+        before start_time of the stops having records in the range
+        :param reader: ArchiveReader
+        :param start_time: beginning of the time range
+        :param end_time: end of the time range, None for the end of the archive
+        :param stops: set of source URLs to read, None to read all of them
+        :return: timestamp, start_time if nothing before it is needed
+        """
+        pending = set()
+        for path in reader.segment_paths(start_time, end_time):
+            for record_time, _, stop in reader.load_index(path):
+                if record_time >= start_time and (end_time is None or record_time <= end_time) \
+                        and (stops is None or stop in stops):
+                    pending.add(stop)
+
+        # Going back from start_time till the data of every stop is found
+        seed = start_time
+        for path in reversed(reader.segment_paths(None, start_time)):
+            if not pending:
+                break
+            index = reader.load_index(path)
+            with open(path, 'rb') as f:
+                for i in range(len(index) - 1, -1, -1):
+                    record_time, offset, stop = index[i]
+                    if record_time >= start_time or stop not in pending:
+                        continue
+                    length = index[i + 1][1] - offset if i + 1 < len(index) else -1
+                    try:
+                        record = reader.read_record(f, offset, length)
+                    except Exception as e:
+                        print("Exception (seed_time): " + path + " at " +
+                              str(record_time) + ": " + str(e), file=sys.stderr)
+                        continue
+                    if 'data' in record:
+                        pending.discard(stop)
+                        seed = min(seed, record_time)
+                        if not pending:
+                            break
+        return seed
+
+    def load(self, reader, start_time=None, end_time=None, stops=None, workers=1):
+        """
+        Read the archive into columns. Segments are read in parallel, unchanged data
+        markers repeat the previous data of the stop at the time of the marker.
+        Reading starts from the last data of every stop before start_time (see seed_time),
+        snapshots before start_time are dropped after that.
+        :param reader: ArchiveReader
+        :param start_time: skip records older than this timestamp, None to read from the beginning
+        :param end_time: stop at records newer than this timestamp, None to read till the end
+        :param stops: set of source URLs to read, None to read all of them
+        :param workers: number of processes reading the segments
+        :return: number of records read
+        """
+        np = self.np
+        read_from = start_time
+        if start_time is not None:
+            read_from = self.seed_time(reader, start_time, end_time, stops)
+        paths = reader.segment_paths(read_from, end_time)
+        parts = []
+        if workers > 1 and len(paths) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                for part in pool.map(self.read_segment, [reader] * len(paths), paths,
+                                     [read_from] * len(paths), [end_time] * len(paths),
+                                     [stops] * len(paths)):
+                    parts.append(self.merge_segment(part))
+        else:
+            for path in paths:
+                parts.append(self.merge_segment(self.read_segment(reader, path, read_from,
+                                                                  end_time, stops)))
+
+        columns = {name: np.concatenate([part[name] for part in parts]) if parts
+                   else np.zeros(0) for name in ('snapshot_time', 'snapshot_stop',
+                                                 'snapshot_block', 'route_block', 'route_route',
+                                                 'route_frequency', 'event_row', 'event_vehicle',
+                                                 'event_estimated', 'event_scheduled')}
+        # Markers not preceded by any data of the stop show nothing, snapshots read
+        # only for their data are not in the time range
+        shown = columns['snapshot_block'] >= 0
+        if start_time is not None and parts:
+            shown &= columns['snapshot_time'] >= start_time
+        self.snapshots = {'time': columns['snapshot_time'][shown],
+                          'stop': columns['snapshot_stop'][shown].astype(np.int64)}
+        snapshot_blocks = columns['snapshot_block'][shown].astype(np.int64)
+        route_blocks = columns['route_block'].astype(np.int64)
+        event_row = columns['event_row'].astype(np.int64)
+
+        # If the route had a vehicle on the way
+        live = np.bincount(event_row[~np.isnan(columns['event_estimated'])],
+                           minlength=len(route_blocks)) > 0
+
+        # Rows of every block are repeated for every snapshot showing this block
+        blocks = self.blocks
+        snapshot, row = self.expand(snapshot_blocks, route_blocks[event_row], blocks)
+        self.events = {'snapshot': snapshot,
+                       'stop': self.snapshots['stop'][snapshot],
+                       'time': self.snapshots['time'][snapshot],
+                       'route': columns['route_route'][event_row[row]].astype(np.int64),
+                       'vehicle': columns['event_vehicle'][row].astype(np.int64),
+                       'estimated': columns['event_estimated'][row],
+                       'scheduled': columns['event_scheduled'][row],
+                       'frequency': columns['route_frequency'][event_row[row]]}
+        snapshot, row = self.expand(snapshot_blocks, route_blocks, blocks)
+        self.routes = {'snapshot': snapshot,
+                       'stop': self.snapshots['stop'][snapshot],
+                       'time': self.snapshots['time'][snapshot],
+                       'route': columns['route_route'][row].astype(np.int64),
+                       'frequency': columns['route_frequency'][row],
+                       'live': live[row]}
+        return len(self.snapshots['time'])
+
+    def merge_segment(self, part):
+        """
+        Convert codes of the segment read by read_segment to the codes of the whole archive
+        :param part: result of read_segment
+        :return: dictionary of NumPy arrays, columns of the segment with global codes
+        """
+        np = self.np
+
+        def global_codes(local_codes, known, keys):
+            # Local code: global code
+            mapping = np.zeros(len(local_codes) + 1, dtype=np.int64)
+            mapping[-1] = -1
+            for key, code in local_codes.items():
+                if key not in known:
+                    known[key] = len(keys)
+                    keys.append(key)
+                mapping[code] = known[key]
+            return mapping
+
+        stop_map = global_codes(part['stop_codes'], self.stop_codes, self.stop_urls)
+        route_map = global_codes(part['route_codes'], self.route_codes, self.route_keys)
+        vehicle_map = global_codes(part['vehicle_codes'], self.vehicle_codes, self.vehicle_ids)
+        self.stop_names += [""] * (len(self.stop_urls) - len(self.stop_names))
+        for code, name in part['stop_names'].items():
+            self.stop_names[stop_map[code]] = name
+
+        columns = {name: np.frombuffer(column, dtype=np.dtype(column.typecode))
+                   if len(column) else np.zeros(0, dtype=np.dtype(column.typecode))
+                   for name, column in part['columns'].items()}
+        snapshot_stop = stop_map[columns['snapshot_stop']]
+        # Markers at the beginning of the segment show the last data of the previous segments
+        previous = np.array([self.last_blocks.get(code, -1) for code in stop_map[:-1].tolist()] +
+                            [-1], dtype=np.int64)
+        snapshot_block = np.where(columns['snapshot_block'] < 0,
+                                  previous[columns['snapshot_stop']],
+                                  columns['snapshot_block'] + self.blocks)
+        route_block = columns['route_block'] + self.blocks
+        event_row = columns['event_row'] + self.route_rows
+        for code, block in part['last_blocks'].items():
+            self.last_blocks[int(stop_map[code])] = block + self.blocks
+        self.blocks += part['blocks']
+        self.route_rows += len(route_block)
+        return {'snapshot_time': columns['snapshot_time'],
+                'snapshot_stop': snapshot_stop,
+                'snapshot_block': snapshot_block,
+                'route_block': route_block,
+                'route_route': route_map[columns['route_route']],
+                'route_frequency': columns['route_frequency'],
+                'event_row': event_row,
+                'event_vehicle': vehicle_map[columns['event_vehicle']],
+                'event_estimated': columns['event_estimated'],
+                'event_scheduled': columns['event_scheduled']}
+
+    def expand(self, snapshot_blocks, row_blocks, blocks):
+        """
+        Join snapshots with rows of their blocks
+        :param snapshot_blocks: block of every snapshot
+        :param row_blocks: block of every row, sorted
+        :param blocks: number of blocks
+        :return: (snapshot of every joined row, row of every joined row)
+        """
+        np = self.np
+        starts = np.searchsorted(row_blocks, np.arange(blocks + 1))
+        counts = (starts[1:] - starts[:-1])[snapshot_blocks]
+        snapshot = np.repeat(np.arange(len(snapshot_blocks)), counts)
+        first = np.cumsum(counts) - counts
+        row = np.repeat(starts[:-1][snapshot_blocks] - first, counts) + np.arange(counts.sum())
+        return snapshot, row
+
+    def local_hours(self, times):
+        """
+        Local hour of the day of the timestamps
+        :param times: array of timestamps
+        :return: array of hours, 0-23
+        """
+        np = self.np
+        utc_hours, inverse = np.unique((times // 3600).astype(np.int64), return_inverse=True)
+        offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in utc_hours.tolist()],
+                           dtype=np.float64)
+        return ((times + offsets[inverse.reshape(-1)]) // 3600 % 24).astype(np.int64)
+
+    def arrivals(self):
+        """
+        Find arrivals of the vehicles: a trip of a vehicle is its events with the same
+        stop and route, the last estimated time of the trip is the arrival. Trips still
+        shown at the end of the archive are not finished and are skipped.
+        :return: dictionary of arrays, one row per arrival: stop, route, time, frequency
+        """
+        np = self.np
+        events = self.events
+        valid = (events['vehicle'] >= 0) & ~np.isnan(events['estimated'])
+        stop = events['stop'][valid]
+        route = events['route'][valid]
+        vehicle = events['vehicle'][valid]
+        seen = events['time'][valid]
+        estimated = events['estimated'][valid]
+        frequency = events['frequency'][valid]
+
+        order = np.lexsort((seen, vehicle, route, stop))
+        stop, route, vehicle = stop[order], route[order], vehicle[order]
+        seen, estimated, frequency = seen[order], estimated[order], frequency[order]
+
+        new_trip = np.ones(len(order), dtype=bool)
+        new_trip[1:] = (stop[1:] != stop[:-1]) | (route[1:] != route[:-1]) | \
+                       (vehicle[1:] != vehicle[:-1]) | \
+                       (seen[1:] - seen[:-1] > self.TRIP_GAP) | \
+                       (np.abs(estimated[1:] - estimated[:-1]) > self.TRIP_GAP)
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = new_trip[1:]
+
+        # Vehicle must disappear while the stop is still watched
+        stop_end = np.full(len(self.stop_urls), -np.inf)
+        np.maximum.at(stop_end, self.snapshots['stop'], self.snapshots['time'])
+        last &= seen < stop_end[stop]
+        return {'stop': stop[last], 'route': route[last],
+                'time': estimated[last], 'frequency': frequency[last]}
+
+    def group_percentiles(self, groups, values, percentile):
+        """
+        Percentile of the values in every group, linear interpolation between values
+        :param groups: group of every value, sorted
+        :param values: values, sorted inside every group
+        :param percentile: 0-100
+        :return: (unique groups, percentile in every group)
+        """
+        np = self.np
+        unique, starts, counts = np.unique(groups, return_index=True, return_counts=True)
+        position = starts + (counts - 1) * percentile / 100
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        return unique, values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def headways(self):
+        """
+        Headway statistics of every route at every stop. Gaps are headways longer than
+        GAP_FACTOR announced intervals, excess is the mean headway time over the announced interval.
+        :return: dictionary, (stop, route): dictionary with 'arrivals', 'headways',
+                 'mean', 'p10'/'p50'/'p90', 'gaps', 'excess' (seconds)
+        """
+        np = self.np
+        arrivals = self.arrivals()
+        routes_count = max(1, len(self.route_keys))
+        group = arrivals['stop'] * routes_count + arrivals['route']
+        order = np.lexsort((arrivals['time'], group))
+        group, arrival_time = group[order], arrivals['time'][order]
+        frequency = arrivals['frequency'][order]
+
+        result = {}
+        for key, count in zip(*np.unique(group, return_counts=True)):
+            result[(int(key) // routes_count, int(key) % routes_count)] = {
+                'arrivals': int(count), 'headways': 0}
+
+        headway = arrival_time[1:] - arrival_time[:-1]
+        valid = (group[1:] == group[:-1]) & (headway > 0) & (headway <= self.MAX_HEADWAY)
+        headway_group = group[1:][valid]
+        headway = headway[valid]
+        frequency = frequency[1:][valid]
+        if len(headway) == 0:
+            return result
+
+        order = np.lexsort((headway, headway_group))
+        headway_group, headway, frequency = headway_group[order], headway[order], frequency[order]
+        unique, index, counts = np.unique(headway_group, return_inverse=True, return_counts=True)
+        index = index.reshape(-1)
+        sums = np.bincount(index, weights=headway)
+        announced = frequency > 0
+        gaps = np.bincount(index, weights=announced & (headway > frequency * self.GAP_FACTOR),
+                           minlength=len(unique))
+        excess = np.bincount(index,
+                             weights=np.where(announced, np.maximum(0, headway - frequency), 0),
+                             minlength=len(unique))
+        percentiles = {'p' + str(p): self.group_percentiles(headway_group, headway, p)[1]
+                       for p in self.PERCENTILES}
+        for i, key in enumerate(unique.tolist()):
+            stats = result[(key // routes_count, key % routes_count)]
+            stats['headways'] = int(counts[i])
+            stats['mean'] = float(sums[i] / counts[i])
+            for name, values in percentiles.items():
+                stats[name] = float(values[i])
+            stats['gaps'] = int(gaps[i])
+            stats['excess'] = float(excess[i] / counts[i])
+        return result
+
+    def frequencies(self):
+        """
+        Median announced interval (BriefSchedule.Frequency) of every route at every stop
+        :return: dictionary, (stop, route): seconds
+        """
+        np = self.np
+        routes_count = max(1, len(self.route_keys))
+        announced = self.routes['frequency'] > 0
+        group = (self.routes['stop'] * routes_count + self.routes['route'])[announced]
+        frequency = self.routes['frequency'][announced]
+        order = np.lexsort((frequency, group))
+        unique, median = self.group_percentiles(group[order], frequency[order], 50)
+        return {(key // routes_count, key % routes_count): float(value)
+                for key, value in zip(unique.tolist(), median.tolist())}
+
+    def availability(self):
+        """
+        Availability of service: share of the snapshots of the stop in every local hour
+        where the route had at least one vehicle with estimated arrival
+        :return: dictionary, (stop, route): list of 24 shares (0-1), None for the hours
+                 without snapshots
+        """
+        np = self.np
+        stops_count = len(self.stop_urls)
+        routes_count = max(1, len(self.route_keys))
+        hours = self.local_hours(self.snapshots['time'])
+        watched = np.bincount(self.snapshots['stop'] * 24 + hours,
+                              minlength=stops_count * 24).reshape(stops_count, 24)
+
+        # A route can be listed several times in one snapshot (different threads)
+        live = self.routes['live']
+        pairs = np.unique(self.routes['snapshot'][live] * routes_count + self.routes['route'][live])
+        snapshot, route = pairs // routes_count, pairs % routes_count
+        served = np.bincount((self.snapshots['stop'][snapshot] * routes_count + route) * 24 +
+                             hours[snapshot],
+                             minlength=stops_count * routes_count * 24)
+        served = served.reshape(stops_count, routes_count, 24)
+        shares = served / np.maximum(watched, 1)[:, None, :]
+
+        result = {}
+        for key in np.unique(self.routes['stop'] * routes_count + self.routes['route']).tolist():
+            stop, route = divmod(key, routes_count)
+            result[(stop, route)] = [float(shares[stop, route, hour]) if watched[stop, hour] else None
+                                     for hour in range(24)]
+        return result
+
+    def report(self):
+        """
+        Results of the analysis
+        :return: list of dictionaries, one per stop, with 'stop', 'name', 'snapshots',
+                 'begin', 'end' and 'routes': list of dictionaries with 'name', 'type',
+                 'frequency', 'availability' and headway statistics (see headways)
+        """
+        np = self.np
+        headways = self.headways()
+        frequencies = self.frequencies()
+        availability = self.availability()
+        from natsort import natsorted
+
+        result = []
+        for stop, url in enumerate(self.stop_urls):
+            times = self.snapshots['time'][self.snapshots['stop'] == stop]
+            if len(times) == 0:
+                continue
+            routes = []
+            for route, (name, route_type) in enumerate(self.route_keys):
+                if (stop, route) not in availability:
+                    continue
+                stats = {'name': name, 'type': route_type,
+                         'frequency': frequencies.get((stop, route)),
+                         'availability': availability[(stop, route)],
+                         'arrivals': 0, 'headways': 0}
+                stats.update(headways.get((stop, route), {}))
+                routes.append(stats)
+            result.append({'stop': url, 'name': self.stop_names[stop],
+                           'snapshots': int(len(times)),
+                           'begin': float(np.min(times)), 'end': float(np.max(times)),
+                           'routes': natsorted(routes, key=lambda stats: stats['name'])})
+        return result
+
+class PollScheduler:
+    """
+    Decides when to poll a stop next time, based on the data received:
+    polls more often when a vehicle is about to arrive, less often when nothing runs,
+    backs off exponentially (with jitter) when the proxy server fails.
+    """
+    # A vehicle closer than this (seconds) is about to arrive
+    ARRIVING_ETA = 120
+
+    # Don't poll arriving vehicles more often than this (seconds), unless wait_time is shorter
+    MIN_WAIT_TIME = 15
+
+    # Wait this many times longer when there's no service at the stop
+    NO_SERVICE_FACTOR = 5
+    NO_SERVICE_MAX_WAIT_TIME = 900
+
+    # Maximum wait time after failures (seconds)
+    MAX_BACKOFF = 600
+
+    # How often data files are checked for changes (seconds)
+    FILE_CHECK_INTERVAL = 1
+
+    def __init__(self, wait_time, adaptive=True):
+        self.wait_time = wait_time
+        self.adaptive = adaptive
+
+    def next_delay(self, stop):
+        """
+        Calculate delay till the next poll of the stop
+        :param stop: StopState, after the poll
+        :return: delay in seconds
+        """
+        if stop.data_source == Application.DATA_SOURCE_FILE:
+            return self.FILE_CHECK_INTERVAL
+
+        if not self.adaptive:
+            return self.wait_time
+
+        if stop.failures > 0:
+            backoff = min(self.MAX_BACKOFF, self.wait_time * 2 ** (stop.failures - 1))
+            return backoff / 2 + random.uniform(0, backoff / 2)
+
+        snapshot = stop.snapshot
+        nearest_arrival = snapshot.nearest_arrival()
+        now = datetime.datetime.now()
+        if nearest_arrival is not None and nearest_arrival < self.ARRIVING_ETA:
+            delay = max(min(self.wait_time, self.MIN_WAIT_TIME),
+                        min(self.wait_time, nearest_arrival / 2))
+        elif not snapshot.view.in_service(now.hour * 60 + now.minute):
+            delay = max(self.wait_time,
+                        min(self.wait_time * self.NO_SERVICE_FACTOR, self.NO_SERVICE_MAX_WAIT_TIME))
+        else:
+            delay = self.wait_time
+
+        # A bit of jitter, so many stops don't hit the proxy server at the same moment
+        return delay * random.uniform(0.9, 1.1)
+
+def parse_address(address):
+    """
+    Parse cache server address
+    :param address: "unix:/path/to/socket", "host:port" or "port"
+    :return: (socket family, address to bind or connect to)
+    :raises ValueError: if the address is malformed
+    """
+    if address.startswith('unix:'):
+        if address[5:] == '':
+            raise ValueError("no socket path")
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(':')
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError("port must be a number from 1 to 65535")
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def check_socket_path(path):
+    """
+    Check what is at the path of a unix socket to listen at
+    :param path: socket path
+    :return: True if a socket left by a previous run is there, False if there is nothing
+    :raises ValueError: if there is something else than a socket at this path
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        raise ValueError(str(e))
+    if not stat.S_ISSOCK(mode):
+        raise ValueError("not a socket: " + path)
+    return True
+
+def make_server_class(base):
+    """
+    Make a subclass of socketserver server class, with daemon threads and reusable
+    address, leaving the socketserver class itself unchanged
+    :param base: server class, like socketserver.ThreadingTCPServer
+    :return: new class
+    """
+    class _Server(base):
+        daemon_threads = True
+        allow_reuse_address = True
+    return _Server
+
+class CacheServer:
+    """
+    Local stop info cache server. Polls every distinct stop requested by clients once
+    and sends each new result to all clients subscribed to this stop, so many timetables
+    showing the same stop make only one query to Yandex Transport Proxy.
+
+    Protocol: client sends one JSON line {"subscribe": [source_url, ...]}, server answers
+    with JSON lines {"stop": source_url, "time": ..., "ok": ..., "error": ..., "data": {...}}
+    each time new data for any of these stops arrives.
+    """
+    # Maximum number of messages waiting to be sent to one client
+    CLIENT_QUEUE_SIZE = 100
+
+    def __init__(self, parent, address, ttl):
+        self.parent = parent
+        self.family, self.address = parse_address(address)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Stop key: StopState being polled
+        self.stops = {}
+        # Stop key: set of client queues
+        self.subscribers = defaultdict(set)
+        # Stop key: time.monotonic() when the last client has left
+        self.abandoned = {}
+        # Stop key: message with the last good result
+        self.cache = {}
+        self.next_index = 0
+        self.server = None
+
+    @staticmethod
+    def stop_key(source_url):
+        """
+        Get the key of the stop, different URLs of the same stop have the same key
+        :param source_url: URL of the stop
+        :return: stop ID if found in URL, URL itself otherwise
+        """
+        match = re.search(r'stopId(?:\]|%5D)=([^&]+)', source_url, re.IGNORECASE)
+        if match:
+            return match.group(1)
+        return source_url
+
+    def subscribe(self, client_queue, source_urls):
+        """
+        Subscribe a client to stops, the stops are polled from now on
+        :param client_queue: queue of messages for the client
+        :param source_urls: list of stop URLs
+        :return: list of cached messages still fresh enough to be sent right away
+        """
+        fresh = []
+        with self.lock:
+            for source_url in source_urls:
+                key = self.stop_key(source_url)
+                self.subscribers[key].add(client_queue)
+                self.abandoned.pop(key, None)
+                if key not in self.stops:
+                    stop = StopState(self.next_index, source_url, Application.DATA_SOURCE_API)
+                    self.next_index += 1
+                    self.stops[key] = stop
+                    self.parent.stops = self.parent.stops + [stop]
+                # Unchanged data is not sent again, the last message is fresh while
+                # the stop is polled successfully
+                cached = self.cache.get(key)
+                if cached is not None and self.stops[key].snapshot.data_collection_status == \
+                        Application.DATA_COLLECTION_OK:
+                    fresh.append(cached)
+        return fresh
+
+    def unsubscribe(self, client_queue):
+        """
+        Unsubscribe client from all stops
+        :param client_queue: queue of messages for the client
+        :return: nothing
+        """
+        with self.lock:
+            for key, clients in self.subscribers.items():
+                if client_queue in clients:
+                    clients.discard(client_queue)
+                    if not clients:
+                        self.abandoned[key] = time.monotonic()
+
+    def expire(self):
+        """
+        Stop polling stops nobody has been subscribed to for longer than ttl
+        :return: nothing
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, since in self.abandoned.items() if now - since > self.ttl]
+            for key in expired:
+                del self.abandoned[key]
+                del self.subscribers[key]
+                self.cache.pop(key, None)
+                stop = self.stops.pop(key)
+                self.parent.stops = [item for item in self.parent.stops if item is not stop]
+                if self.parent.vehicle_tracker is not None:
+                    self.parent.vehicle_tracker.forget(stop)
+
+    def __call__(self, stop, snapshot):
+        """
+        Snapshot listener, sends new data to subscribed clients
+        :param stop: StopState
+        :param snapshot: StopSnapshot
+        :return: nothing
+        """
+        ok = snapshot.data_collection_status == Application.DATA_COLLECTION_OK
+        message = (json.dumps({'stop': stop.source_url, 'time': time.time(), 'ok': ok,
+                               'error': snapshot.display_error, 'data': snapshot.data},
+                              ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        key = self.stop_key(stop.source_url)
+        with self.lock:
+            if ok:
+                self.cache[key] = message
+            clients = list(self.subscribers.get(key, ()))
+        for client_queue in clients:
+            try:
+                client_queue.put_nowait(message)
+            except queue.Full:
+                # Slow client, the oldest message is dropped
+                try:
+                    client_queue.get_nowait()
+                    client_queue.put_nowait(message)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def make_handler(self):
+        """
+        Make request handler class for socketserver
+        :return: socketserver.BaseRequestHandler subclass
+        """
+        import socketserver
+        cache_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """
+            Serves one cache client
+            """
+            def handle(self):
                 try:
-                    json_data = self.proxy.get_stop_info(self.parent.source_url,
-                                                         timeout=self.parent.timeout)
-                    self.parent.data_collection_status = self.parent.DATA_COLLECTION_OK
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                    source_urls = [str(url) for url in request['subscribe']]
                 except Exception as e:
-                    self.parent.display_error = str(e)
-                    self.parent.data_collection_status = self.parent.DATA_COLLECTION_FAILED
+                    self.wfile.write((json.dumps({'error': "Bad request: " + str(e)}) +
+                                      '\n').encode('utf-8'))
+                    return
+                client_queue = queue.Queue(maxsize=cache_server.CLIENT_QUEUE_SIZE)
+                for message in cache_server.subscribe(client_queue, source_urls):
+                    client_queue.put_nowait(message)
+                try:
+                    while cache_server.parent.is_running:
+                        try:
+                            message = client_queue.get(timeout=1)
+                        except queue.Empty:
+                            continue
+                        self.wfile.write(message)
+                        self.wfile.flush()
+                except OSError:
+                    pass
+                finally:
+                    cache_server.unsubscribe(client_queue)
 
-            self.parent.update_time = str(datetime.datetime.now().time().strftime('%H:%M:%S'))
+        return Handler
 
-            # Storing data to file if log_dir was specified
-            if self.parent.log_dir != '':
-                filename = self.parent.log_dir + '/' + \
-                           str(datetime.datetime.now()).replace(':', '_') + \
-                           '.json'
+    def start(self):
+        """
+        Start listening in a separate thread
+        :return: nothing
+        """
+        import socketserver
+        if self.family == socket.AF_UNIX:
+            if check_socket_path(self.address):
+                os.remove(self.address)
+            server_class = make_server_class(socketserver.ThreadingUnixStreamServer)
+        else:
+            server_class = make_server_class(socketserver.ThreadingTCPServer)
+        self.server = server_class(self.address, self.make_handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """
+        Stop listening
+        :return: nothing
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.family == socket.AF_UNIX:
                 try:
-                    f = open(filename, 'w', encoding='utf-8')
-                    f.write(json.dumps(json_data, ensure_ascii=False,
-                                       indent=4, separators=(',', ': ')))
-                    f.close()
-                except Exception as e:
-                    self.parent.display_error = str(e)
+                    if check_socket_path(self.address):
+                        os.remove(self.address)
+                except ValueError:
+                    # Replaced by something else while running, leave it alone
+                    pass
+
+class CacheClientThread(threading.Thread):
+    """
+    Cache Client Thread class, gets data of the stops from the local cache server
+    (see CacheServer) instead of querying Yandex Transport Proxy directly.
+    """
+    # Maximum delay between reconnection attempts, seconds
+    MAX_RECONNECT_DELAY = 30
+
+    def __init__(self, parent, address):
+        super().__init__()
+        self.parent = parent
+        self.family, self.address = parse_address(address)
 
+    def receive(self, stops):
+        """
+        Connect to the cache server and publish everything it sends till disconnected
+        :param stops: dictionary, stop key: list of StopState
+        :return: nothing
+        """
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.parent.timeout)
+            sock.connect(self.address)
+            source_urls = [stop_list[0].source_url for stop_list in stops.values()]
+            sock.sendall((json.dumps({'subscribe': source_urls}) + '\n').encode('utf-8'))
+            # Short timeout, to notice when the program is finishing
+            sock.settimeout(1)
+            buffer = b''
+            while self.parent.is_running:
+                try:
+                    chunk = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    raise ConnectionError("cache server closed connection")
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    self.publish(stops, json.loads(line.decode('utf-8')))
+        finally:
+            sock.close()
+
+    def publish(self, stops, message):
+        """
+        Publish data received from the cache server
+        :param stops: dictionary, stop key: list of StopState
+        :param message: message from the cache server
+        :return: nothing
+        """
+        if 'stop' not in message:
+            raise ValueError(message.get('error', 'bad message from cache server'))
+        status = self.parent.DATA_COLLECTION_OK if message['ok'] else \
+            self.parent.DATA_COLLECTION_FAILED
+        update_time = datetime.datetime.fromtimestamp(message['time']).strftime('%H:%M:%S')
+        snapshot = self.parent.make_snapshot(message['data'], status, message['error'],
+                                             update_time, message['time'])
+        for stop in stops.get(CacheServer.stop_key(message['stop']), []):
+            self.parent.publish(stop, snapshot)
+
+    def run(self):
+        stops = defaultdict(list)
+        for stop in self.parent.stops:
+            if stop.data_source == self.parent.DATA_SOURCE_CACHE:
+                stops[CacheServer.stop_key(stop.source_url)].append(stop)
+        delay = 1
+        while self.parent.is_running:
             try:
-                self.parent.yandex_timestamp, _ = self.parent.get_yandex_timestamp(json_data)
+                self.receive(stops)
             except Exception as e:
-                self.parent.display_error = "Exception (getting Yandex timestamp)" + str(e)
+                for stop_list in stops.values():
+                    for stop in stop_list:
+                        self.parent.publish(stop, stop.snapshot._replace(
+                            display_error="Cache server: " + str(e)))
+                # Waiting before reconnection, a bit longer each time
+                end = time.monotonic() + delay
+                while self.parent.is_running and time.monotonic() < end:
+                    time.sleep(0.2)
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+            else:
+                delay = 1
+        print("CACHE CLIENT THREAD TERMINATED!")
 
-            # Copy data to parent
-            self.parent.data_lock.acquire()
-            self.parent.data = json_data.copy()
-            self.parent.data_lock.release()
+class Histogram:
+    """
+    Histogram with fixed buckets (upper bounds in seconds), same as Prometheus histograms
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-            # Wait for some time
-            for _ in range(0, self.parent.wait_time):
-                if not self.parent.is_running:
-                    break
-                time.sleep(1)
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS
+        # Last one is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram
+        :param value: value, seconds
+        :return: nothing
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls into
+        :param q: quantile, 0.5 for median
+        :return: value, float('inf') if above the largest bucket, None if empty
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bucket
+        return float('inf')
+
+class Metrics:
+    """
+    Performance counters and latency histograms of polling and rendering,
+    updated from any thread.
+    """
+    PREFIX = 'timetable_'
+
+    COUNTERS = {
+        'polls_total': "Queries to the proxy server and data file reads",
+        'poll_failures_total': "Failed queries and data file reads",
+        'poll_timeouts_total': "Queries failed because of timeout",
+        'unchanged_total': "Queries returned the same routes and arrivals as last time",
+        'retries_total': "Queries retried because the connection to the proxy server failed",
+        'abandoned_total': "Queries abandoned because they were too slow",
+        'coalesced_total': "Queries answered by the same query already in progress",
+        'file_bytes_total': "Bytes read from data files",
+        'archive_bytes_total': "Compressed bytes written to log_dir",
+        'archive_dropped_total': "Records not written to log_dir because the queue was full",
+        'screen_bytes_total': "Bytes written to the terminal",
+        'frames_total': "Frames drawn",
+        'dropped_frames_total': "Frames skipped because the screen loop was late",
+        'arrivals_total': "Vehicles arrived at the stops, as followed by the vehicle tracker",
+        'missed_arrivals_total': "Arrivals shown to passengers too late to catch the vehicle",
+        'phantom_arrivals_total': "Vehicles disappeared long before their estimated arrival",
+    }
+
+    HISTOGRAMS = {
+        'poll_seconds': "Time of one query to the proxy server or data file read",
+        'rate_limit_seconds': "Time a query waited because of the rate limit",
+        'snapshot_seconds': "Time to process received data for the screen",
+        'archive_write_seconds': "Time to write one record to log_dir",
+        'frame_seconds': "Time to draw one frame",
+        'eta_drift_seconds': "How far estimated arrival of a vehicle moved from its first estimation",
+        'eta_error_seconds': "Difference between estimated arrivals shown and the arrival",
+    }
+
+    # Buckets of the histograms not measuring processing time
+    HISTOGRAM_BUCKETS = {
+        'eta_drift_seconds': (10, 30, 60, 120, 180, 300, 600, 900, 1800),
+        'eta_error_seconds': (10, 30, 60, 120, 180, 300, 600, 900, 1800),
+    }
+
+    GAUGES = {
+        'stops': "Stops being displayed or served",
+        'uptime_seconds': "Time since start",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {name: Histogram(self.HISTOGRAM_BUCKETS.get(name))
+                           for name in self.HISTOGRAMS}
+        self.gauges = dict.fromkeys(self.GAUGES, 0)
+        self.start_time = time.monotonic()
+
+    def inc(self, name, value=1):
+        """
+        Increase a counter
+        :param name: counter name, from COUNTERS
+        :param value: increment
+        :return: nothing
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        """
+        Add a value to a histogram
+        :param name: histogram name, from HISTOGRAMS
+        :param value: value, seconds
+        :return: nothing
+        """
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def set(self, name, value):
+        """
+        Set a gauge
+        :param name: gauge name, from GAUGES
+        :param value: value
+        :return: nothing
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def render(self):
+        """
+        Render all metrics in Prometheus text exposition format
+        :return: string
+        """
+        lines = []
+        with self.lock:
+            self.gauges['uptime_seconds'] = round(time.monotonic() - self.start_time, 3)
+            for name, value in self.counters.items():
+                lines.append('# HELP ' + self.PREFIX + name + ' ' + self.COUNTERS[name])
+                lines.append('# TYPE ' + self.PREFIX + name + ' counter')
+                lines.append(self.PREFIX + name + ' ' + str(value))
+            for name, value in self.gauges.items():
+                lines.append('# HELP ' + self.PREFIX + name + ' ' + self.GAUGES[name])
+                lines.append('# TYPE ' + self.PREFIX + name + ' gauge')
+                lines.append(self.PREFIX + name + ' ' + str(value))
+            for name, histogram in self.histograms.items():
+                lines.append('# HELP ' + self.PREFIX + name + ' ' + self.HISTOGRAMS[name])
+                lines.append('# TYPE ' + self.PREFIX + name + ' histogram')
+                total = 0
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    total += count
+                    lines.append(self.PREFIX + name + '_bucket{le="' + str(bucket) + '"} ' +
+                                 str(total))
+                lines.append(self.PREFIX + name + '_bucket{le="+Inf"} ' + str(histogram.count))
+                lines.append(self.PREFIX + name + '_sum ' + repr(round(histogram.sum, 6)))
+                lines.append(self.PREFIX + name + '_count ' + str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def seconds_string(value, largest=Histogram.BUCKETS[-1]):
+        """
+        Format a quantile for the status line
+        :param value: seconds, None or float('inf')
+        :param largest: largest bucket of the histogram
+        :return: string, like "25мс" or "2.5с"
+        """
+        if value is None:
+            return "--"
+        if value == float('inf'):
+            return ">" + str(largest) + "с"
+        if value < 1:
+            return ('%g' % (value * 1000)) + "мс"
+        return ('%g' % value) + "с"
+
+    def status_line(self):
+        """
+        Short summary of the metrics for the screen
+        :return: string
+        """
+        with self.lock:
+            poll = self.histograms['poll_seconds']
+            frame = self.histograms['frame_seconds']
+            error = self.histograms['eta_error_seconds']
+            return ("ОПРОСЫ: " + str(self.counters['polls_total']) +
+                    " ОШИБКИ: " + str(self.counters['poll_failures_total']) +
+                    " ТАЙМАУТЫ: " + str(self.counters['poll_timeouts_total']) +
+                    " | ОПРОС p50/p95: " + self.seconds_string(poll.quantile(0.5)) +
+                    "/" + self.seconds_string(poll.quantile(0.95)) +
+                    " | КАДР p95: " + self.seconds_string(frame.quantile(0.95)) +
+                    " ПРОПУЩЕНО: " + str(self.counters['dropped_frames_total']) +
+                    " | ПРОГНОЗ p50/p90: ±" +
+                    self.seconds_string(error.quantile(0.5), error.buckets[-1]) + "/" +
+                    self.seconds_string(error.quantile(0.9), error.buckets[-1]) +
+                    " ПРИЗРАКИ: " + str(self.counters['phantom_arrivals_total']))
+
+class MetricsExporter(threading.Thread):
+    """
+    Metrics Exporter Thread class, periodically writes metrics to a Prometheus textfile
+    (for node_exporter textfile collector) and serves them over HTTP at /metrics.
+    """
+    # How often to rewrite the textfile, seconds
+    FILE_INTERVAL = 15
+
+    def __init__(self, parent, filename, address):
+        super().__init__()
+        self.parent = parent
+        self.filename = filename
+        self.address = address
+        self.server = None
+        # Last error of writing the textfile or starting the server, empty if none
+        self.error = ""
+
+    def report_error(self, error):
+        """
+        Keep the error to show it on the screen, printing it only once if there is no screen
+        :param error: error message
+        :return: nothing
+        """
+        if self.error != error and not self.parent.screen_active:
+            print(error, file=sys.stderr)
+        self.error = error
+
+    def render(self):
+        """
+        Render current metrics
+        :return: string in Prometheus text exposition format
+        """
+        self.parent.metrics.set('stops', len(self.parent.stops))
+        return self.parent.metrics.render()
+
+    def write_file(self):
+        """
+        Write metrics to the textfile, replacing it at once so it's never read half-written
+        :return: nothing
+        """
+        temp_filename = self.filename + '.tmp'
+        try:
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                f.write(self.render())
+            os.replace(temp_filename, self.filename)
+        except Exception as e:
+            self.report_error("Exception (metrics file write): " + str(e))
+            return
+        if self.error.startswith("Exception (metrics file write)"):
+            self.error = ""
+
+    def make_handler(self):
+        """
+        Make HTTP request handler class
+        :return: http.server.BaseHTTPRequestHandler subclass
+        """
+        import http.server
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """
+            Serves /metrics
+            """
+            def do_GET(self):
+                """
+                Answer with metrics in Prometheus text format at / and /metrics
+                :return: nothing
+                """
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                """
+                Don't log requests, they must not be printed over the curses screen
+                :return: nothing
+                """
+
+        return Handler
+
+    def start_server(self):
+        """
+        Start HTTP server in a separate thread
+        :return: nothing
+        """
+        import http.server
+        import socketserver
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            if check_socket_path(address):
+                os.remove(address)
+            server_class = make_server_class(socketserver.ThreadingUnixStreamServer)
+        else:
+            server_class = make_server_class(http.server.ThreadingHTTPServer)
+        self.server = server_class(address, self.make_handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def run(self):
+        if self.address != '':
+            try:
+                self.start_server()
+            except Exception as e:
+                self.report_error("Exception (metrics server): " + str(e))
+        next_write = 0
+        while self.parent.is_running:
+            if self.filename != '' and time.monotonic() >= next_write:
+                self.write_file()
+                next_write = time.monotonic() + self.FILE_INTERVAL
+            time.sleep(0.5)
+        if self.filename != '':
+            self.write_file()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        print("METRICS EXPORTER TERMINATED!")
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: allows `rate` events per second on average
+    and bursts of up to `burst` events.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """
+        Wait for a token
+        :param deadline: time.monotonic() when to give up
+        :return: seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            wait = max(0, (1 - self.tokens) / self.rate)
+            if now + wait > deadline:
+                raise TimeoutError("Timeout: too many queries to the proxy server")
+            # Token is taken in advance, so waiting threads get tokens in turn
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class ProxyPool:
+    """
+    Pool of Yandex Transport Proxy clients shared by all poll workers.
+    Clients are reused instead of being created for every query, at most `size` queries
+    run at once, failed connections are retried, and queries slower than their deadline
+    are abandoned: the poll gets a timeout right away, the query finishes in background
+    and its client is thrown away.
+    Queries are spread in time by a token bucket, and a query for a stop which is
+    already being queried waits for the result of that query instead.
+    """
+    # How many times to retry a query if the connection to the proxy server fails
+    RETRIES = 1
+    RETRY_DELAY = 0.5
+
+    def __init__(self, host, port, size, rate, burst, metrics):
+        import concurrent.futures
+        self.host = host
+        self.port = port
+        self.size = max(1, size)
+        self.metrics = metrics
+        # Rate limit of queries to the proxy server, None for no limit
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        # Stop key: Future with the result of the query in progress
+        self.in_flight = {}
+        # Idle clients, the most recently used one is taken first
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        # Clients created and not thrown away yet
+        self.clients = 0
+        # Queries run here, so the waiting poll can give up on them.
+        # Abandoned queries still take a thread till the proxy client times out.
+        self.requests = concurrent.futures.ThreadPoolExecutor(max_workers=self.size * 2,
+                                                              thread_name_prefix='proxy')
+
+    def checkout(self, timeout):
+        """
+        Take an idle client or create a new one
+        :param timeout: how long to wait for a client if all of them are busy, seconds
+        :return: YandexTransportProxy instance
+        """
+        from yandex_transport_webdriver_api import YandexTransportProxy
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.clients < self.size:
+                self.clients += 1
+                return YandexTransportProxy(self.host, self.port)
+        try:
+            return self.idle.get(timeout=max(0, timeout))
+        except queue.Empty as e:
+            raise TimeoutError("Timeout: all proxy clients are busy") from e
+
+    def checkin(self, client):
+        """
+        Return the client to the pool
+        :param client: YandexTransportProxy instance from checkout
+        :return: nothing
+        """
+        self.idle.put(client)
+
+    def discard(self):
+        """
+        Throw away a client which failed or was abandoned, a new one is created instead
+        :return: nothing
+        """
+        with self.lock:
+            self.clients -= 1
+
+    def get_stop_info(self, source_url, deadline):
+        """
+        Get stop info from the proxy server, or from the same query already in progress
+        :param source_url: URL of the stop
+        :param deadline: time.monotonic() when to give up
+        :return: Yandex JSON from getStopInfo, must not be modified
+        """
+        import concurrent.futures
+        key = CacheServer.stop_key(source_url)
+        with self.lock:
+            future = self.in_flight.get(key)
+            in_progress = future is not None
+            if not in_progress:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+
+        if in_progress:
+            self.metrics.inc('coalesced_total')
+            try:
+                return future.result(timeout=max(0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError as e:
+                raise TimeoutError("Timeout: no answer from the proxy server in time") from e
+
+        try:
+            result = self.query(source_url, deadline)
+        except Exception as e:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.in_flight[key]
+        future.set_result(result)
+        return result
+
+    def query(self, source_url, deadline):
+        """
+        Query stop info from the proxy server
+        :param source_url: URL of the stop
+        :param deadline: time.monotonic() when to give up
+        :return: Yandex JSON from getStopInfo
+        """
+        import concurrent.futures
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.metrics.observe('rate_limit_seconds', self.bucket.acquire(deadline))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Timeout: no answer from the proxy server in time")
+            client = self.checkout(remaining)
+            future = self.requests.submit(client.get_stop_info, source_url,
+                                          timeout=max(1, int(remaining)))
+            try:
+                result = future.result(timeout=max(0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError as e:
+                future.add_done_callback(lambda _future: self.discard())
+                self.metrics.inc('abandoned_total')
+                raise TimeoutError("Timeout: no answer from the proxy server in time") from e
+            except Exception as e:
+                if not self.is_connection_failure(e):
+                    self.checkin(client)
+                    raise
+                # Connection refused or reset, worth another try
+                self.discard()
+                if attempt >= self.RETRIES or deadline - time.monotonic() < self.RETRY_DELAY:
+                    raise
+                attempt += 1
+                self.metrics.inc('retries_total')
+                time.sleep(self.RETRY_DELAY)
+                continue
+            self.checkin(client)
+            return result
+
+    @staticmethod
+    def is_connection_failure(error):
+        """
+        Check if the query failed because the proxy server could not be reached.
+        YandexTransportProxy reports refused connection as a plain Exception
+        ("Failed to connect to server"), other socket errors come as OSError.
+        :param error: exception raised by YandexTransportProxy.get_stop_info
+        :return: True if the query is worth another try
+        """
+        if isinstance(error, OSError):
+            return True
+        return type(error) is Exception and "Failed to connect" in str(error)
+
+    def close(self):
+        """
+        Stop accepting queries, abandoned ones are not waited for
+        :return: nothing
+        """
+        self.requests.shutdown(wait=False)
+
+class ExecutorThread(threading.Thread):
+    """
+    Executor Thread class, will periodically poll Yandex Transport Proxy server.
+    All stops are polled concurrently, at most max_workers of them at a time,
+    so one refresh takes about as long as the slowest stop.
+    Every stop is polled at its own pace, decided by PollScheduler.
+    """
+    def __init__(self, parent, host, port, max_workers):
+        super().__init__()
+        self.parent = parent
+        self.max_workers = max_workers
+        self.scheduler = PollScheduler(parent.wait_time, parent.adaptive_polling)
+        # Proxy clients shared by all workers
+        self.proxy_pool = ProxyPool(host, port, max_workers, parent.rate, parent.burst,
+                                    parent.metrics)
+
+    def poll_stop(self, stop):
+        """
+        Get data for one stop and publish it as a new snapshot
+        :param stop: StopState to poll
+        :return: data collection status, None if nothing has changed
+        """
+        display_error = ""
+        json_data = []
+        metrics = self.parent.metrics
+        start_time = time.perf_counter()
+        # Raw data is parsed in full only if it has to be archived as is
+        fields = None if self.parent.log_raw else self.parent.STOP_INFO_FIELDS
+
+        if stop.data_source == self.parent.DATA_SOURCE_FILE:
+            try:
+                json_data, stop.file_signature = \
+                    self.parent.load_data_from_file(stop.source_url, stop.file_signature, fields)
+            except Exception as e:
+                display_error = "Exception (data load from file)" + str(e)
+                metrics.inc('polls_total')
+                metrics.inc('poll_failures_total')
+                # Keep showing the last good data, the file is probably being rewritten
+                if stop.snapshot.data_collection_status == self.parent.DATA_COLLECTION_OK:
+                    self.parent.publish(stop, stop.snapshot._replace(display_error=display_error))
+                    return self.parent.DATA_COLLECTION_FAILED
+                status = self.parent.DATA_COLLECTION_FAILED
+            else:
+                # File has not changed, nothing to do
+                if json_data is None:
+                    return None
+                status = self.parent.DATA_COLLECTION_OK
+                metrics.inc('polls_total')
+                metrics.inc('file_bytes_total', stop.file_signature[1])
+                metrics.observe('poll_seconds', time.perf_counter() - start_time)
+        else:
+            try:
+                json_data = self.proxy_pool.get_stop_info(stop.source_url,
+                                                          time.monotonic() + self.parent.timeout)
+                status = self.parent.DATA_COLLECTION_OK
+            except Exception as e:
+                display_error = str(e)
+                status = self.parent.DATA_COLLECTION_FAILED
+                metrics.inc('poll_failures_total')
+                if isinstance(e, (TimeoutError, socket.timeout)) or 'timeout' in str(e).lower():
+                    metrics.inc('poll_timeouts_total')
+            metrics.inc('polls_total')
+            metrics.observe('poll_seconds', time.perf_counter() - start_time)
+
+            # Keep showing data from the warm start cache till fresh data arrives
+            if status == self.parent.DATA_COLLECTION_FAILED and stop.snapshot.stale:
+                self.parent.publish(stop, stop.snapshot._replace(display_error=display_error))
+                return status
+
+        update_time = str(datetime.datetime.now().time().strftime('%H:%M:%S'))
+
+        # Only the fields needed to display the stop are kept
+        raw_data = json_data
+        unchanged = False
+        if status == self.parent.DATA_COLLECTION_OK:
+            if fields is None or stop.data_source != self.parent.DATA_SOURCE_FILE:
+                json_data = self.parent.prune_data(raw_data, self.parent.STOP_INFO_FIELDS)
+            fingerprint = self.parent.fingerprint(json_data)
+            unchanged = fingerprint == stop.fingerprint
+            stop.fingerprint = fingerprint
+        else:
+            stop.fingerprint = None
+
+        # Storing data to archive if log_dir was specified
+        archive_writer = self.parent.archive_writer
+        if archive_writer is not None:
+            if unchanged:
+                archive_writer.put(stop.source_url, None)
+            elif status == self.parent.DATA_COLLECTION_OK:
+                archive_writer.put(stop.source_url, raw_data if self.parent.log_raw else json_data)
+            if archive_writer.error != "" and display_error == "":
+                display_error = archive_writer.error
+
+        # Same routes and arrivals as last time, only the clock is moved
+        previous = stop.snapshot
+        if unchanged and previous.data_collection_status == self.parent.DATA_COLLECTION_OK and \
+                previous.display_error == display_error:
+            metrics.inc('unchanged_total')
+            snapshot = self.parent.refresh_snapshot(previous, json_data, update_time)
+            self.parent.publish(stop, snapshot, notify=False)
+            if self.parent.vehicle_tracker is not None:
+                self.parent.vehicle_tracker.touch(stop, snapshot.yandex_timestamp)
+            return status
+
+        # Publish the data, json_data is never modified after this point
+        start_time = time.perf_counter()
+        snapshot = self.parent.make_snapshot(json_data, status, display_error, update_time)
+        metrics.observe('snapshot_seconds', time.perf_counter() - start_time)
+        self.parent.publish(stop, snapshot)
+        return status
+
+    def poll_and_schedule(self, stop):
+        """
+        Poll the stop and decide when to poll it next time
+        :param stop: StopState to poll
+        :return: nothing
+        """
+        try:
+            status = self.poll_stop(stop)
+        except Exception as e:
+            print("Exception (poll_stop): " + str(e), file=sys.stderr)
+            status = self.parent.DATA_COLLECTION_FAILED
+
+        if status == self.parent.DATA_COLLECTION_FAILED:
+            stop.failures += 1
+        elif status == self.parent.DATA_COLLECTION_OK:
+            stop.failures = 0
+        stop.next_poll = time.monotonic() + self.scheduler.next_delay(stop)
+
+    def run(self):
+        import concurrent.futures
+        # Worker threads are started only when needed
+        workers = max(1, self.max_workers)
+        # Polls in progress, stop index: future
+        in_progress = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while self.parent.is_running:
+                now = time.monotonic()
+                next_poll = now + 1
+                for stop in self.parent.stops:
+                    if stop.data_source == self.parent.DATA_SOURCE_CACHE:
+                        continue
+                    future = in_progress.get(stop.index)
+                    if future is not None:
+                        if not future.done():
+                            continue
+                        del in_progress[stop.index]
+                    if stop.next_poll <= now:
+                        in_progress[stop.index] = pool.submit(self.poll_and_schedule, stop)
+                    else:
+                        next_poll = min(next_poll, stop.next_poll)
+
+                # Wait till the next poll, but not longer than a second
+                time.sleep(max(0.05, next_poll - time.monotonic()))
+        self.proxy_pool.close()
         print("EXECUTOR THREAD TERMINATED!")
 
 class Application:
@@ -126,6 +2825,47 @@ class Application:
     # Data sources
     DATA_SOURCE_API = 0
     DATA_SOURCE_FILE = 1
+    DATA_SOURCE_REPLAY = 2
+    DATA_SOURCE_CACHE = 3
+
+    # Fields of getStopInfo JSON used by this program, everything else is dropped right
+    # after the data is received. For lists, fields of their items are listed.
+    STOP_INFO_FIELDS = {'data': {'properties': {
+        'name': True,
+        'currentTime': True,
+        'StopMetaData': {'Transport': {
+            'id': True,
+            'lineId': True,
+            'threadId': True,
+            'name': True,
+            'type': True,
+            'EssentialStops': {'name': True},
+            'BriefSchedule': {
+                'Frequency': {'text': True, 'value': True,
+                              'begin': {'text': True}, 'end': {'text': True}},
+                'Events': {'vehicleId': True,
+                           'Estimated': {'value': True, 'text': True},
+                           'Scheduled': {'value': True, 'text': True}}}}}}}}
+
+    # Fields of getStopInfo JSON telling if anything has changed since the last query
+    FINGERPRINT_FIELDS = {'data': {'properties': {
+        'name': True,
+        'StopMetaData': {'Transport': {
+            'id': True,
+            'lineId': True,
+            'threadId': True,
+            'name': True,
+            'type': True,
+            'EssentialStops': True,
+            'BriefSchedule': {
+                'Frequency': True,
+                'Events': {'vehicleId': True,
+                           'Estimated': {'value': True},
+                           'Scheduled': True}}}}}}}
+
+    # Fields of log_dir archive records
+    ARCHIVE_RECORD_FIELDS = {'time': True, 'stop': True, 'unchanged': True,
+                             'data': STOP_INFO_FIELDS}
 
     ROUTE_NAME_PREFERRED_WIDTH = 5
     ROUTE_NAME_ELNARGE_LOWER_TRESHOLD = 105
@@ -133,10 +2873,25 @@ class Application:
 
     ROUTE_TERMINALS_LENGTH_PREFERRED = 30
 
-    SCREEN_WIDTH_STANDARD = 80
-    SCREEN_WIDTH_NO_FREQ_AND_HOURS = 60
-    SCREEN_WIDTH_NO_HOURS = 70
-    SCREEN_WIDTH_MINIMAL = 40
+    SCREEN_WIDTH_STANDARD = 80
+    SCREEN_WIDTH_NO_FREQ_AND_HOURS = 60
+    SCREEN_WIDTH_NO_HOURS = 70
+    SCREEN_WIDTH_MINIMAL = 40
+
+    # Lines taken by stop header (name, time, separator, empty line)
+    STOP_HEADER_LINES = 4
+
+    # Lines at the bottom of the screen (error message and footer)
+    FOOTER_LINES = 2
+
+    # Time between frames of running lines and wobbling icons, seconds
+    FRAME_INTERVAL = 0.5
+
+    # Time between frames when nothing moves on the screen (the clock ticks), seconds
+    CLOCK_INTERVAL = 1.0
+
+    # How many records can wait to be written to log_dir
+    ARCHIVE_QUEUE_SIZE = 1000
 
     def __init__(self):
         # Proxy Server host and port
@@ -146,42 +2901,111 @@ class Application:
         # Delay between queries, default is 1 minute
         self.wait_time = 60
 
+        # If true, delay between queries changes depending on the data
+        self.adaptive_polling = True
+
         # Timeout in getting the data
         self.timeout = 60
 
-        # Data lock
-        self.data_lock = threading.Lock()
-
-        # Data source URL
-        self.source_url = ''
+        # Rate limit of queries to the proxy server, queries per second and burst size
+        self.rate = 2.0
+        self.burst = 4
 
-        # Time when data was updated
-        self.update_time = "--:--:--"
+        # Maximum number of simultaneous queries to the proxy server
+        self.max_workers = 4
 
-        # Yandex Timestamp from collected data
-        self.yandex_timestamp = None
+        # Stops to display (StopState)
+        self.stops = []
 
         # While true, the program will run
         self.is_running = True
 
-        # Data to present on screen
-        self.data = []
+        # Directory to store data from Yandex in JSON format
+        self.log_dir = ''
+
+        # Maximum size (MB) and age (seconds) of one log_dir segment file
+        self.log_max_size = 64
+        self.log_rotate_time = 3600
 
-        # Data collection source
-        self.data_source = self.DATA_SOURCE_API
+        # Store data to log_dir as received, not only the fields used by this program
+        self.log_raw = False
 
-        # Data collection status
-        self.data_collection_status = self.DATA_COLLECTION_PENDING
+        # Archive writer thread
+        self.archive_writer = None
 
-        # Error to display on screen
-        self.display_error = ""
+        # Replay data from this log_dir archive instead of polling
+        self.replay_dir = ''
 
-        # Directory to store data from Yandex in JSON format
-        self.log_dir = ''
+        # Replay speed (1 - real time, 0 - as fast as possible) and start timestamp
+        self.replay_speed = 1.0
+        self.replay_from = None
+
+        # If true, only stops given in command line are replayed
+        self.replay_filter = False
 
         # Executor thread
         self.executor_thread = None
 
+        # Positions of everything on the screen, recomputed when terminal size changes
+        self.layout = Layout(0, 0)
+
+        # First line of the timetable shown on the screen
+        self.scroll = 0
+
+        # Scroll to the next page every auto_page seconds, 0 to switch off
+        self.auto_page = 0
+
+        # Functions called with (stop, snapshot) each time a new snapshot is published
+        self.snapshot_listeners = []
+
+        # Performance metrics, exported to metrics_file and/or at metrics_address
+        self.metrics = Metrics()
+        self.metrics_file = ''
+        self.metrics_address = ''
+        self.metrics_exporter = None
+
+        # Curses is using the terminal, errors of background threads are shown on the
+        # screen instead of being printed
+        self.screen_active = False
+
+        # Show metrics status line above the footer
+        self.show_metrics = False
+
+        # File to keep the last good data of the stops in, for warm start
+        self.warm_cache_file = ''
+        self.warm_cache = None
+
+        # Follows vehicles across snapshots, to measure quality of estimated arrivals
+        self.vehicle_tracker = None
+
+        # Address of the local cache server to get data from, empty to query the proxy
+        self.cache_address = ''
+
+        # Address to run the local cache server at, empty if not a cache server
+        self.serve_address = ''
+
+        # How long the cache server keeps data and keeps polling abandoned stops
+        self.cache_ttl = 120
+
+        # Cache client thread and cache server
+        self.cache_client = None
+        self.cache_server = None
+
+        # If true, no curses screen, data is written as JSON lines to output
+        self.headless = False
+        self.output = '-'
+        self.output_stream = None
+
+        # Pipe (read fd, write fd) waking up the main loop on new snapshots and signals
+        self.wakeup_pipe = None
+
+        # Set by SIGWINCH handler, the curses screen must be resized
+        self.terminal_resized = False
+
+        # Set while drawing a frame if something on the screen moves (running lines,
+        # wobbling icons), so the next frame must be drawn in FRAME_INTERVAL
+        self.animated = False
+
     def sigint_handler(self, _signal, _frame):
         """
         Haldner for SIGINT (and SIGTERM) signals
@@ -193,6 +3017,15 @@ class Application:
         if self.executor_thread is not None:
             self.executor_thread.join()
 
+    def sigwinch_handler(self, _signal, _frame):
+        """
+        Handler for SIGWINCH signal (terminal size changed)
+        :param _signal: signal
+        :param _frame: frame
+        :return: nothing
+        """
+        self.terminal_resized = True
+
     @staticmethod
     def route_terminals_width(screen_width):
         """
@@ -250,40 +3083,155 @@ class Application:
         return 'ДРУГОЙ ТРАНСПОРТ'
 
     @staticmethod
-    def load_data_from_file(filename):
+    def file_signature(stat_result):
+        """
+        Get file signature, it changes each time the file is modified or replaced
+        :param stat_result: result of os.stat() or os.fstat()
+        :return: tuple (inode, size, modification time)
+        """
+        return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+    @staticmethod
+    def load_data_from_file(filename, signature=None, fields=None):
         """
-        Load JSON data from file, for debug purposes.
+        Load JSON data from file, for debug purposes. The file is read only if it has changed.
+        Works with files replaced by rename (the opened file is checked, not the name)
+        and detects files modified while being read.
         :param filename: name of the file to load data from
-        :return: dictionary, containing loaded data
+        :param signature: signature of the file loaded last time, None to always load it
+        :param fields: fields to keep (see prune_data), None to keep everything
+        :return: (data, signature), data is None if the file has not changed
+        """
+        if signature is not None and \
+                Application.file_signature(os.stat(filename)) == signature:
+            return None, signature
+
+        with open(filename, 'rb') as f:
+            opened_signature = Application.file_signature(os.fstat(f.fileno()))
+            if opened_signature == signature:
+                return None, signature
+            data = Application.parse_json(f, fields)
+            if Application.file_signature(os.fstat(f.fileno())) != opened_signature:
+                raise ValueError("file was modified while reading, will retry")
+
+        return data, opened_signature
+
+    @staticmethod
+    def prune_data(value, fields):
+        """
+        Drop everything not listed in fields
+        :param value: JSON value (dictionary, list or scalar)
+        :param fields: True to keep the whole value, dictionary of fields to keep otherwise,
+                       like STOP_INFO_FIELDS
+        :return: new JSON value, the original one is not modified
+        """
+        if fields is True:
+            return value
+        if isinstance(value, dict):
+            return {key: Application.prune_data(item, fields[key])
+                    for key, item in value.items() if key in fields}
+        if isinstance(value, list):
+            return [Application.prune_data(item, fields) for item in value]
+        return value
+
+    @staticmethod
+    def stream_json(f, fields):
         """
-        data = json.load(open(filename, 'r', encoding='utf-8'))
-        return data
+        Parse JSON with ijson, building only the listed fields, everything else
+        is skipped while parsing
+        :param f: file opened in binary mode
+        :param fields: fields to keep, see prune_data
+        :return: JSON value
+        """
+        import ijson
+        result = None
+        # Dictionaries and lists being filled, (container, fields of its items)
+        stack = []
+        key = None
+        # Nesting depth inside the value being skipped, 0 if nothing is skipped
+        skip = 0
+        for event, value in ijson.basic_parse(f, use_float=True):
+            if skip > 0:
+                if event in ('start_map', 'start_array'):
+                    skip += 1
+                elif event in ('end_map', 'end_array'):
+                    skip -= 1
+                continue
+            if event in ('end_map', 'end_array'):
+                stack.pop()
+                continue
+            if event == 'map_key':
+                # Same keys in every route share the same string, as json.load does
+                key = sys.intern(value)
+                continue
+
+            item_fields = fields
+            if stack:
+                container, container_fields = stack[-1]
+                if isinstance(container, list) or container_fields is True:
+                    item_fields = container_fields
+                else:
+                    item_fields = container_fields.get(key)
+                    if item_fields is None:
+                        if event in ('start_map', 'start_array'):
+                            skip = 1
+                        continue
+
+            if event == 'start_map':
+                item = {}
+            elif event == 'start_array':
+                item = []
+            else:
+                item = value
+
+            if not stack:
+                result = item
+            elif isinstance(container, list):
+                container.append(item)
+            else:
+                container[key] = item
+            if event in ('start_map', 'start_array'):
+                stack.append((item, item_fields))
+        return result
+
+    @staticmethod
+    def parse_json(f, fields=None):
+        """
+        Parse JSON from a file, keeping only the listed fields. If ijson with a C backend
+        is installed, the rest is never built in memory, otherwise it's dropped after parsing.
+        :param f: file opened in binary mode
+        :param fields: fields to keep (see prune_data), None to keep everything
+        :return: JSON value
+        """
+        if fields is None:
+            return json.load(f)
+        ijson = import_optional('ijson')
+        if ijson is not None and ijson.backend != 'python':
+            return Application.stream_json(f, fields)
+        return Application.prune_data(json.load(f), fields)
 
-    def get_routes(self, data):
+    @staticmethod
+    def get_routes(data):
         """
         Get routes from data (Yandex getStopInfo JSON)
         :param data: result of get_stop_info (Yandex getStopInfo function)
-        :return: list of routes (as dictionaries)
+        :return: list of routes (as dictionaries), None if there are no routes in data
         """
-        if self.data_collection_status == self.DATA_COLLECTION_OK:
-            try:
-                return data['data']['properties']['StopMetaData']['Transport']
-            except Exception as e:
-                self.data_collection_status = self.DATA_COLLECTION_FAILED
-                self.display_error = "Exception (get_routes): failed to get " + str(e)
-                return []
-        else:
-            return []
+        try:
+            return data['data']['properties']['StopMetaData']['Transport']
+        except:
+            return None
 
     @staticmethod
     def sort_routes(routes):
         """
         Perform natural sort of the routes
-        :param routes: routes from get_routes()
+        :param routes: list of Route
         :return: "naturally" sorted routes
         """
+        from natsort import natsorted
         try:
-            result = natsorted(routes, key=lambda route: route['name'])
+            result = natsorted(routes, key=lambda route: route.name)
         except Exception as e:
             print("Exception (sort_routes):" + str(e), file=sys.stderr)
             result = []
@@ -294,13 +3242,12 @@ class Application:
     def split_routes_by_type(routes):
         """
         Split routes by type (buses, trolleybuses, tramways, minibuses etc)
-        :param routes: routes
+        :param routes: list of Route
         :return: dictionary: {'type': array_of_routes_of_this_type,}
         """
         result = defaultdict(list)
-        for value in routes:
-            if 'type' in value:
-                result[value['type']].append(value)
+        for route in routes:
+            result[route.type].append(route)
 
         return result
 
@@ -324,12 +3271,155 @@ class Application:
 
         return result, result_str
 
-    def draw_table_header(self, stdscr, start_line, data):
+    def build_view(self, data, status):
+        """
+        Prepare routes for drawing: sort, group by type and generate all strings
+        :param data: Yandex JSON from getStopInfo
+        :param status: data collection status
+        :return: StopView, None if data contains no routes
+        """
+        if status != self.DATA_COLLECTION_OK:
+            return StopView()
+
+        # Getting the routes from data
+        routes = self.get_routes(data)
+        if routes is None:
+            return None
+
+        # Parsing the routes, routes of unknown type are not displayed
+        routes = [self.parse_route(route) for route in routes if 'type' in route]
+
+        # Sorting the data by route name
+        routes = self.sort_routes(routes)
+
+        # Splitting the data by route types
+        routes_by_type = self.split_routes_by_type(routes)
+
+        eta_stamps = [eta_stamp for route in routes for eta_stamp in route.eta_stamps]
+        nearest_eta = min(eta_stamps) if eta_stamps else None
+
+        return StopView(list(routes_by_type.items()), nearest_eta)
+
+    def make_snapshot(self, data, status, display_error, update_time, received=None,
+                      clock_rate=1):
+        """
+        Make a snapshot of the stop from freshly received data
+        :param data: Yandex JSON from getStopInfo
+        :param status: data collection status
+        :param display_error: error to display on screen
+        :param update_time: time when data was received, string
+        :param received: time.time() when data was received from Yandex, None for "right now"
+        :param clock_rate: Yandex seconds passing in one local second, replay speed for replay
+        :return: StopSnapshot
+        """
+        yandex_timestamp, _ = self.get_yandex_timestamp(data)
+        clock_offset = self.get_clock_offset(yandex_timestamp, received, clock_rate)
+
+        # Prepare routes for drawing, so the screen only has to print them
+        view = self.build_view(data, status)
+        if view is None:
+            view = StopView()
+            status = self.DATA_COLLECTION_FAILED
+            display_error = "Exception (build_view): failed to get routes"
+
+        return StopSnapshot(data=data,
+                            view=view,
+                            yandex_timestamp=yandex_timestamp,
+                            clock_offset=clock_offset,
+                            update_time=update_time,
+                            data_collection_status=status,
+                            display_error=display_error,
+                            clock_rate=clock_rate)
+
+    @staticmethod
+    def get_clock_offset(yandex_timestamp, received=None, clock_rate=1):
+        """
+        Tie Yandex clock to the local monotonic clock, to move ETAs between queries
+        :param yandex_timestamp: timestamp from get_yandex_timestamp
+        :param received: time.time() when data was received from Yandex, None for "right now"
+        :param clock_rate: Yandex seconds passing in one local second
+        :return: offset to add to time.monotonic() times clock_rate, None if there is
+                 no Yandex timestamp
+        """
+        if yandex_timestamp is None:
+            return None
+        age = 0 if received is None else max(0, time.time() - received)
+        return yandex_timestamp - (time.monotonic() - age) * clock_rate
+
+    def refresh_snapshot(self, snapshot, data, update_time):
+        """
+        Make a snapshot from freshly received data, which is the same as in the previous
+        snapshot except for the current time, the view is not rebuilt
+        :param snapshot: previous StopSnapshot
+        :param data: Yandex JSON from getStopInfo, same fingerprint as snapshot data
+        :param update_time: time when data was received, string
+        :return: StopSnapshot
+        """
+        yandex_timestamp, _ = self.get_yandex_timestamp(data)
+        return snapshot._replace(data=data,
+                                 yandex_timestamp=yandex_timestamp,
+                                 clock_offset=self.get_clock_offset(yandex_timestamp, None,
+                                                                    snapshot.clock_rate),
+                                 update_time=update_time)
+
+    @staticmethod
+    def fingerprint(data):
+        """
+        Fingerprint of the data, same for data with the same routes and arrivals,
+        no matter when it was received
+        :param data: Yandex JSON from getStopInfo
+        :return: bytes
+        """
+        import hashlib
+        relevant = Application.prune_data(data, Application.FINGERPRINT_FIELDS)
+        return hashlib.blake2b(json.dumps(relevant, sort_keys=True, ensure_ascii=False,
+                                          separators=(',', ':')).encode('utf-8'),
+                               digest_size=16).digest()
+
+    def publish(self, stop, snapshot, notify=True):
+        """
+        Publish new snapshot of the stop to the screen and to all snapshot listeners
+        :param stop: StopState
+        :param snapshot: StopSnapshot
+        :param notify: False to update the screen only, if nothing has changed for listeners
+        :return: nothing
+        """
+        stop.snapshot = snapshot
+        self.wake_up()
+        if not notify:
+            return
+        for listener in self.snapshot_listeners:
+            listener(stop, snapshot)
+
+    def wake_up(self):
+        """
+        Wake up the main loop to draw a new frame right away
+        :return: nothing
+        """
+        if self.wakeup_pipe is None:
+            return
+        try:
+            os.write(self.wakeup_pipe[1], b'\0')
+        except OSError:
+            # Pipe is full, the main loop will wake up anyway
+            pass
+
+    def background_error(self):
+        """
+        Error of a background thread, shown when no stop has an error to show
+        :return: error message, empty string if none
+        """
+        for component in (self.metrics_exporter, self.warm_cache):
+            if component is not None and component.error != "":
+                return component.error
+        return ""
+
+    def draw_table_header(self, stdscr, start_line, snapshot):
         """
         Draw table header
         :param stdscr: curses screen
         :param start_line: current line
-        :param data: Yandex JSON from getStopInfo
+        :param snapshot: StopSnapshot, data is Yandex JSON from getStopInfo
         :return: current line after drawing
         """
         current_line = start_line
@@ -339,12 +3429,12 @@ class Application:
             stdscr.move(current_line, 0)
             stdscr.addstr("ОСТАНОВКА : ")
             stdscr.move(current_line, 12)
-            stdscr.addstr(data['data']['properties']['name'])
+            stdscr.addstr(snapshot.data['data']['properties']['name'])
         except:
             try:
-                if self.data_collection_status == 0:
+                if snapshot.data_collection_status == 0:
                     stdscr.addstr('ИДЕТ СБОР ДАННЫХ')
-                elif self.data_collection_status == 2:
+                elif snapshot.data_collection_status == 2:
                     stdscr.addstr('НЕТ ДАННЫХ')
                 else:
                     stdscr.addstr('????')
@@ -359,26 +3449,25 @@ class Application:
             stdscr.addstr("ВРЕМЯ     : " + str(datetime.datetime.now().time().strftime("%H:%M:%S")))
 
             # Update time
-            stdscr.move(current_line, stdscr.getmaxyx()[1] - 21)
-            if self.update_time is not None:
-                stdscr.addstr("ОБНОВЛЕНО : " + self.update_time)
+            stdscr.move(current_line, self.layout.update_time_x)
+            if snapshot.update_time is not None:
+                stdscr.addstr(("УСТАРЕЛО  : " if snapshot.stale else "ОБНОВЛЕНО : ") +
+                              snapshot.update_time)
         except:
             pass
         current_line += 1
 
         # THRIRD: SEPARATOR
-        for j in range(0, stdscr.getmaxyx()[1]):
-            try:
-                stdscr.move(current_line, j)
-                stdscr.addstr('-')
-            except:
-                pass
+        try:
+            stdscr.move(current_line, 0)
+            stdscr.addstr(self.layout.separator)
+        except:
+            pass
         current_line += 1
 
         return current_line
 
-    @staticmethod
-    def draw_footer(stdscr, current_line, source_url):
+    def draw_footer(self, stdscr, current_line, source_url):
         """
         Draw footer of timetable
         :param stdscr: curses screen
@@ -387,10 +3476,10 @@ class Application:
         :return nothing:
         """
         # FIRST LINE: DATA SOURCE
-        if current_line >= stdscr.getmaxyx()[0]:
+        if current_line >= self.layout.height:
             return
         try:
-            stdscr.move(stdscr.getmaxyx()[0] - 1, 0)
+            stdscr.move(self.layout.footer_y, 0)
             stdscr.addstr("ИСТОЧНИК ДАННЫХ: " + source_url)
         except:
             pass
@@ -403,10 +3492,11 @@ class Application:
         :param route_type:
         :return:
         """
+        layout = self.layout
         current_line = start_line
         try:
-            stdscr.move(start_line, 3)
-            stdscr.addstr(self.route_type_to_name(route_type).upper().center(stdscr.getmaxyx()[1] - 2))
+            stdscr.move(start_line, layout.title_x)
+            stdscr.addstr(layout.route_type_title(route_type))
         except:
             pass
 
@@ -419,31 +3509,28 @@ class Application:
             pass
 
         try:
-            if stdscr.getmaxyx()[1] >= Application.SCREEN_WIDTH_MINIMAL:
-                line_width = self.route_terminals_width(stdscr.getmaxyx()[1])
-                stdscr.move(current_line,
-                            14 + self.route_name_width(stdscr.getmaxyx()[1]) -
-                            Application.ROUTE_NAME_PREFERRED_WIDTH)
-                stdscr.addstr("МАРШРУТ".center(line_width))
+            if layout.show_terminals:
+                stdscr.move(current_line, layout.terminals_x)
+                stdscr.addstr(layout.columns_terminals)
         except:
             pass
 
         try:
-            if stdscr.getmaxyx()[1] >= Application.SCREEN_WIDTH_NO_HOURS:
-                stdscr.move(current_line, stdscr.getmaxyx()[1] - 33)
+            if layout.show_hours:
+                stdscr.move(current_line, layout.columns_hours_x)
                 stdscr.addstr("ЧАСЫ РАБОТЫ")
         except:
             pass
 
         try:
-            if stdscr.getmaxyx()[1] >= Application.SCREEN_WIDTH_NO_FREQ_AND_HOURS:
-                stdscr.move(current_line, stdscr.getmaxyx()[1] - 20)
+            if layout.show_frequency:
+                stdscr.move(current_line, layout.columns_frequency_x)
                 stdscr.addstr("ЧАСТОТА")
         except:
             pass
 
         try:
-            stdscr.move(current_line, stdscr.getmaxyx()[1] - 11)
+            stdscr.move(current_line, layout.arrivals_x)
             stdscr.addstr("БЛИЖАЙШИЕ")
         except:
             pass
@@ -451,6 +3538,23 @@ class Application:
 
         return current_line
 
+    @staticmethod
+    def parse_route(route):
+        """
+        Parse route from Yandex JSON
+        :param route: route subset of original data JSON (single route)
+        :return: Route
+        """
+        begin_minutes, end_minutes = Application.get_operating_minutes(route)
+        return Route(str(route.get('name', "????")),
+                     route['type'],
+                     Application.generate_route_terminals_string(route),
+                     Application.generate_operating_hours_string(route),
+                     Application.generate_route_frequency_string(route),
+                     begin_minutes,
+                     end_minutes,
+                     Application.get_route_events(route))
+
     @staticmethod
     def generate_route_terminals_string(route):
         """
@@ -491,59 +3595,119 @@ class Application:
         return operating_hours
 
     @staticmethod
-    def calculate_arrivals(route, yandex_timestamp):
+    def generate_route_frequency_string(route):
         """
-        Calculate "arrivals" string, based on Yandex ETA prognosis.
-        Can be two types, "how many minutes left till next one" and
-        "when is next scheduled departure/arrival"
-        :param route: route subset of original data JSON (single route)
-        :param yandex_timestamp: timestamp from get_yandex_timestamp
-        :return: string containing nearest arrivals/schedules
+        Generate "route frequency" string
+        :param route: subset of original data JSON (single route)
+        :return: "route frequency" string
         """
-        # If no Yandex Timestamp available, then exit
-        if yandex_timestamp is None:
-            return '', False
+        try:
+            return route['BriefSchedule']['Frequency']['text']
+        except:
+            return ""
 
-        is_now = False
-        events_string = ""
-        scheduled_string = ""
+    @staticmethod
+    def get_operating_minutes(route):
+        """
+        Get operating hours of the route
+        :param route: subset of original data JSON (single route)
+        :return: (begin, end), minutes since midnight, (None, None) if unknown
+        """
+        try:
+            frequency = route['BriefSchedule']['Frequency']
+            begin_hours, begin_minutes = frequency['begin']['text'].split(':')
+            end_hours, end_minutes = frequency['end']['text'].split(':')
+            return (int(begin_hours) * 60 + int(begin_minutes),
+                    int(end_hours) * 60 + int(end_minutes))
+        except:
+            return None, None
+
+    @staticmethod
+    def is_operating(route, now_minutes):
+        """
+        Check if the route operates now, according to its operating hours
+        :param route: Route
+        :param now_minutes: current time, minutes since midnight
+        :return: False if the route surely does not operate now, True otherwise
+        """
+        begin = route.begin_minutes
+        end = route.end_minutes
+        if begin is None or end is None:
+            return True
+
+        if begin <= end:
+            return begin <= now_minutes < end
+        # Operates past midnight
+        return now_minutes >= begin or now_minutes < end
+
+    @staticmethod
+    def get_route_events(route):
+        """
+        Get estimated arrivals and scheduled departures/arrivals of the route
+        :param route: route subset of original data JSON (single route)
+        :return: list of Event
+        """
+        events = []
         if 'BriefSchedule' in route:
             if 'Events' in route['BriefSchedule']:
                 for vehicle in route['BriefSchedule']['Events']:
+                    vehicle_id = vehicle.get('vehicleId')
                     if 'Estimated' in vehicle:
                         try:
-                            eta_stamp = float(vehicle['Estimated']['value'])
-                            arrival_estimation = eta_stamp - yandex_timestamp
+                            events.append(Event(vehicle_id,
+                                                float(vehicle['Estimated']['value']), None))
                         except:
-                            arrival_estimation = None
-
-                        if arrival_estimation is not None:
-                            # Mark the route as "now arriving" if less than 1.5 mins left till
-                            # closest arrival
-                            if arrival_estimation < 90:
-                                is_now = True
-                            if arrival_estimation < 0:
-                                arrival_estimation = 0
-                            arrival_estimation = int(arrival_estimation // 60)
-                            events_string += str(arrival_estimation) + " "
-                        else:
                             pass
 
                     elif 'Scheduled' in vehicle:
                         try:
-                            scheduled_string += vehicle['Scheduled']['text'] + " "
+                            events.append(Event(vehicle_id, None,
+                                                str(vehicle['Scheduled']['text'])))
                         except:
-                            scheduled_string += "-" + " "
+                            events.append(Event(vehicle_id, None, "-"))
+
+        return events
+
+    @staticmethod
+    def estimate_minutes(eta_stamps, yandex_timestamp):
+        """
+        Calculate minutes till estimated arrivals, arrivals already in the past are dropped
+        :param eta_stamps: estimated arrival timestamps, Route.eta_stamps
+        :param yandex_timestamp: current time in Yandex clock
+        :return: (list of minutes, True if something is arriving now)
+        """
+        is_now = False
+        estimated = []
+        for eta_stamp in eta_stamps:
+            arrival_estimation = eta_stamp - yandex_timestamp
+            # The vehicle should have arrived already, the next poll will tell
+            if arrival_estimation < 0:
+                continue
+            # Mark the route as "now arriving" if less than 1.5 mins left till
+            # closest arrival
+            if arrival_estimation < 90:
+                is_now = True
+            estimated.append(int(arrival_estimation // 60))
+        return estimated, is_now
 
-        return events_string + scheduled_string, is_now
+    @staticmethod
+    def arrivals_string(estimated, scheduled):
+        """
+        Make "arrivals" string from the results of Route.arrival_times
+        :param estimated: list of minutes till estimated arrivals
+        :param scheduled: list of scheduled times
+        :return: string containing nearest arrivals/schedules
+        """
+        return ''.join(str(minutes) + " " for minutes in estimated) + \
+               ''.join(text + " " for text in scheduled)
 
     @staticmethod
-    def draw_transport_symbol(stdscr, line_number, route, time_counter, is_now):
+    def draw_transport_symbol(stdscr, line_number, symbol, time_counter, is_now):
         """
         Draw transport symbol
         :param stdscr: curses screen
         :param line_number: current line number
-        :param route: route subset of Yandex JSON from getStopInfo
+        :param symbol: transport symbol, Route.symbol
         :param time_counter: current time counter
         :param is_now: if true, the icon will "wobble" a little
         :return: nothing
@@ -560,32 +3724,30 @@ class Application:
                 return
 
         try:
-            try:
-                stdscr.addstr(SYMBOLS[route['type']])
-            except:
-                stdscr.addstr(SYMBOLS['unknown'])
+            stdscr.addstr(symbol)
         except:
             return
 
-    def draw_route_name(self, stdscr, current_line, route, time_counter):
+    def draw_route_name(self, stdscr, current_line, route_name, time_counter):
         """
         Draw route name.  Will do "running line" if string is to big.
         :param stdscr: curses screen
         :param current_line: current line
-        :param route: route subset of Yandex JSON from getStopInfo
+        :param route_name: route name, Route.name
         :param time_counter: current time counter
         :return: nothing
         """
-        line_width = self.route_name_width(stdscr.getmaxyx()[1])
-        route_name_len = len(route['name'])
+        line_width = self.layout.name_width
+        route_name_len = len(route_name)
 
         try:
-            stdscr.move(current_line, 5)
+            stdscr.move(current_line, self.layout.name_x)
 
             if route_name_len <= line_width:
-                stdscr.addstr(route['name'].ljust(line_width))
+                stdscr.addstr(route_name.ljust(line_width))
             else:
-                endless_name = route['name'] + "   "
+                self.animated = True
+                endless_name = route_name + "   "
                 route_name_len = len(endless_name)
                 cntr = time_counter % route_name_len
                 outstr = endless_name[cntr:(cntr + line_width)] + endless_name
@@ -602,11 +3764,9 @@ class Application:
         :param time_counter: current time counter
         :return: nothing
         """
-        line_width = self.route_terminals_width(stdscr.getmaxyx()[1])
+        line_width = self.layout.terminals_width
         try:
-            stdscr.move(current_line,
-                        14 + self.route_name_width(stdscr.getmaxyx()[1]) -
-                        Application.ROUTE_NAME_PREFERRED_WIDTH)
+            stdscr.move(current_line, self.layout.terminals_x)
 
             str_len = len(route_terminals)
             if str_len < line_width:
@@ -615,6 +3775,7 @@ class Application:
                 except:
                     pass
             else:
+                self.animated = True
                 # Buffer for endless loop running line
                 route_terminals += "         "
                 str_len = len(route_terminals)
@@ -628,8 +3789,7 @@ class Application:
         except:
             pass
 
-    @staticmethod
-    def draw_operating_hours(stdscr, current_line, operating_hours):
+    def draw_operating_hours(self, stdscr, current_line, operating_hours):
         """
         Draw operating hours
         :param stdscr: curses screen
@@ -638,7 +3798,7 @@ class Application:
         :return: nothing
         """
         try:
-            stdscr.move(current_line, stdscr.getmaxyx()[1] - 34)
+            stdscr.move(current_line, self.layout.hours_x)
             try:
                 stdscr.addstr(operating_hours)
             except:
@@ -646,26 +3806,21 @@ class Application:
         except:
             pass
 
-    @staticmethod
-    def draw_route_frequency(stdscr, current_line, route):
+    def draw_route_frequency(self, stdscr, current_line, frequency):
         """
         Draw route frequency.
         :param stdscr: curses screen
         :param current_line: current line
-        :param route: route subset of Yandex JSON from getStopInfo
+        :param frequency: string containing route frequency
         :return: nothing
         """
         try:
-            stdscr.move(current_line, stdscr.getmaxyx()[1] - 19)
-            try:
-                stdscr.addstr(route['BriefSchedule']['Frequency']['text'])
-            except:
-                stdscr.addstr("")
+            stdscr.move(current_line, self.layout.frequency_x)
+            stdscr.addstr(frequency)
         except:
             pass
 
-    @staticmethod
-    def draw_arrivals(stdscr, current_line, arrivals):
+    def draw_arrivals(self, stdscr, current_line, arrivals):
         """
         Draw route frequency.
         :param stdscr: curses screen
@@ -674,44 +3829,42 @@ class Application:
         :return: nothing
         """
         try:
-            stdscr.move(current_line, stdscr.getmaxyx()[1] - 11)
+            stdscr.move(current_line, self.layout.arrivals_x)
             estimated_arrival_time = (arrivals)[0:12].rsplit(' ', 1)[0]
             stdscr.addstr(estimated_arrival_time)
         except:
             pass
 
-    def draw_transport_data(self, stdscr, line_number, route, time_counter):
+    def draw_transport_data(self, stdscr, line_number, row, yandex_now, time_counter):
         """
         Draw a line with route info
         :param stdscr: curses screen
         :param line_number: current line number
-        :param route: route subset of Yandex JSON from getStopInfo
+        :param row: Route, prepared route info
+        :param yandex_now: current time in Yandex clock, from StopSnapshot.yandex_now
         :param time_counter: current time counter
         :return: current line after printing
         """
         current_line = line_number
 
-        # Generate route terminals
-        route_terminals = self.generate_route_terminals_string(route)
-        # Generating operating hours
-        operating_hours = self.generate_operating_hours_string(route)
-
-        # Calculating nearest arrival:
-        arrivals, is_now = self.calculate_arrivals(route, self.yandex_timestamp)
+        # Calculating nearest arrivals for this very moment
+        arrivals, is_now = row.arrivals(yandex_now)
+        if is_now:
+            self.animated = True
 
         # Display transport symbol
-        self.draw_transport_symbol(stdscr, current_line, route, time_counter, is_now)
+        self.draw_transport_symbol(stdscr, current_line, row.symbol, time_counter, is_now)
         # Display route name
-        self.draw_route_name(stdscr, current_line, route, time_counter)
+        self.draw_route_name(stdscr, current_line, row.name, time_counter)
         # Display route terminals
-        if stdscr.getmaxyx()[1] >= 40:
-            self.draw_route_terminals(stdscr, current_line, route_terminals, time_counter)
+        if self.layout.show_terminals:
+            self.draw_route_terminals(stdscr, current_line, row.terminals, time_counter)
         # Display route frequency
-        if stdscr.getmaxyx()[1] >= 60:
-            self.draw_route_frequency(stdscr, current_line, route)
+        if self.layout.show_frequency:
+            self.draw_route_frequency(stdscr, current_line, row.frequency)
         # Display operating hours
-        if stdscr.getmaxyx()[1] >= 70:
-            self.draw_operating_hours(stdscr, current_line, operating_hours)
+        if self.layout.show_hours:
+            self.draw_operating_hours(stdscr, current_line, row.operating_hours)
         # Display arrivals
         self.draw_arrivals(stdscr, current_line, arrivals)
 
@@ -719,8 +3872,7 @@ class Application:
 
         return current_line
 
-    @staticmethod
-    def display_error_message(stdscr, current_line, error_message):
+    def display_error_message(self, stdscr, current_line, error_message):
         """
         Display message with error at the bottom of the screen
         :param stdscr: curses screen
@@ -729,22 +3881,34 @@ class Application:
         :return: nothing
         """
         try:
-            stdscr.move(stdscr.getmaxyx()[0]-2, 0)
+            stdscr.move(self.layout.error_y, 0)
             stdscr.addstr(error_message)
         except:
             pass
 
         return current_line + 1
 
-    @staticmethod
-    def park_cursor(stdscr):
+    def draw_metrics(self, stdscr, status_line):
+        """
+        Draw metrics status line above the error message
+        :param stdscr: curses screen
+        :param status_line: metrics summary
+        :return: nothing
+        """
+        try:
+            stdscr.move(self.layout.metrics_y, 0)
+            stdscr.addstr(status_line[:self.layout.metrics_width])
+        except:
+            pass
+
+    def park_cursor(self, stdscr):
         """
         Move cursor to upper right edge of the screen.
         :param stdscr: curses screen
         :return: nothing
         """
         try:
-            stdscr.move(0, stdscr.getmaxyx()[1] - 1)
+            stdscr.move(0, self.layout.cursor_x)
         except:
             pass
 
@@ -754,80 +3918,126 @@ class Application:
         not break the terminal.
         :return:
         """
+        import curses
         time_counter = 0
+        last_page_time = time.monotonic()
 
-        while self.is_running:
-            # Preparing the screen to print new data iteration
-            stdscr.clear()
-            stdscr.refresh()
-
-            # Lock to prevent data being overwritten in the process of reading it.
-            self.data_lock.acquire()
-
-            # Getting Yandex Timestamp from Yandex Timestring
-            # Why. Don't. They. Send. Time. As. Timestamp. WHY???
+        # Time (perf_counter) when the next frame is due, None if it is not planned yet
+        next_frame_time = None
+        # Frame is drawn because its time has come, not because of a key or new data
+        is_tick = True
 
-            # Getting the routes from data
-            routes = self.get_routes(self.data)
+        # Everything is drawn to the frame buffer first, only the changes get to the terminal
+        frame = FrameBuffer()
 
-            # Sorting the data by route name
-            routes = self.sort_routes(routes)
+        # Waiting for keys, new snapshots and signals all at once
+        selector, previous_handlers = None, None
+        if self.wakeup_pipe is not None:
+            selector, previous_handlers = self.start_event_loop()
 
-            # Splitting the data by route types
-            routes_by_type = self.split_routes_by_type(routes)
+        while self.is_running:
+            frame_time = time.perf_counter()
+
+            if is_tick:
+                # The loop was late, counting frames that should have been drawn meanwhile
+                if next_frame_time is not None and \
+                        frame_time - next_frame_time >= self.FRAME_INTERVAL:
+                    self.metrics.inc('dropped_frames_total',
+                                     int((frame_time - next_frame_time) / self.FRAME_INTERVAL))
+                next_frame_time = None
+
+            if self.terminal_resized:
+                self.terminal_resized = False
+                self.resize_terminal()
+
+            # Preparing the screen to print new data iteration, the layout is
+            # recomputed only when the terminal size changes
+            screen_size = stdscr.getmaxyx()
+            if frame.getmaxyx() != screen_size:
+                frame.resize(*screen_size)
+                self.layout = Layout(*screen_size)
+            frame.clear()
+
+            # Executor thread may publish a new snapshot any moment, reading them only once
+            snapshots = [stop.snapshot for stop in self.stops]
+
+            # Lines available for the timetable itself
+            footer_lines = self.FOOTER_LINES + (1 if self.show_metrics else 0)
+            body_height = max(1, self.layout.height - footer_lines)
+            total_lines = sum(self.STOP_HEADER_LINES + len(snapshot.view.lines)
+                              for snapshot in snapshots)
+
+            # Turning the page for unattended boards
+            if self.auto_page > 0 and time.monotonic() - last_page_time >= self.auto_page:
+                last_page_time = time.monotonic()
+                if self.scroll + body_height >= total_lines:
+                    self.scroll = 0
+                else:
+                    self.scroll += body_height
+            self.scroll = max(0, min(self.scroll, total_lines - body_height))
 
-            # Drawing the timetable in curses, starting from line 0
+            # Drawing only the lines visible on the screen, line_number is the line
+            # of the whole timetable, counting from its top
+            frame.set_bottom(body_height)
+            self.animated = False
             line_number = 0
+            for snapshot in snapshots:
+                stop_lines = self.STOP_HEADER_LINES + len(snapshot.view.lines)
+                if line_number + stop_lines <= self.scroll:
+                    line_number += stop_lines
+                    continue
+                if line_number >= self.scroll + body_height:
+                    break
 
-            # ---- Table header
-            line_number = self.draw_table_header(stdscr, line_number, self.data)
-
-            # Leave one empty line
-            line_number += 1
-
-            # Displaying error message, if present
-            if self.display_error != "":
-                self.display_error_message(stdscr, line_number, self.display_error)
-
-            # ---- Drawing body of the timetable
-
-            # How many lines to skip
-            skip_lines = 0
-
-            # Current lines counter
-            line_counter = 0
-
-            for route_type, routes_list in routes_by_type.items():
-                # Printing route type segment header
-
-                line_number = self.draw_route_type_header(stdscr, line_number, route_type)
-
-                for route in routes_list:
-                    # Skipping first <skip_lines> lines.
-                    line_counter += 1
-                    if line_counter < skip_lines:
-                        continue
-
-                    # Draw transport data line
-                    line_number = self.draw_transport_data(stdscr,
-                                                           line_number,
-                                                           route,
-                                                           time_counter)
+                # ---- Table header
+                if line_number >= self.scroll:
+                    self.draw_table_header(frame, line_number - self.scroll, snapshot)
+                line_number += self.STOP_HEADER_LINES
+
+                # ---- Drawing body of the timetable
+                self.draw_stop_lines(frame, snapshot, line_number, body_height, time_counter)
+                line_number += len(snapshot.view.lines)
+            frame.set_bottom(None)
+
+            # Displaying error message, if present. First error found is displayed
+            # at the bottom of the screen
+            for snapshot in snapshots:
+                if snapshot.display_error != "":
+                    self.display_error_message(frame, body_height, snapshot.display_error)
+                    break
+            else:
+                error = self.background_error()
+                if error != "":
+                    self.display_error_message(frame, body_height, error)
 
-                # Add an empty line between route type segments
-                line_number += 1
+            self.draw_footer(frame, body_height,
+                             ", ".join(stop.source_url for stop in self.stops))
 
-            self.draw_footer(stdscr, line_number, self.source_url)
+            if self.show_metrics:
+                self.draw_metrics(frame, self.metrics.status_line())
 
             # Move cursor to the upper right corner of the screen
-            self.park_cursor(stdscr)
+            self.park_cursor(frame)
+
+            # Sending changes to the terminal
+            self.metrics.inc('screen_bytes_total', frame.flush(stdscr))
+            self.metrics.inc('frames_total')
+            self.metrics.observe('frame_seconds', time.perf_counter() - frame_time)
 
-            # Releasing the data lock
-            self.data_lock.release()
+            # Running lines and wobbling icons move every FRAME_INTERVAL, otherwise only
+            # the clock ticks, and the page turns
+            if self.animated:
+                frame_delay = self.FRAME_INTERVAL
+            else:
+                frame_delay = self.CLOCK_INTERVAL - time.time() % self.CLOCK_INTERVAL
+            if self.auto_page > 0:
+                frame_delay = min(frame_delay,
+                                  max(0, last_page_time + self.auto_page - time.monotonic()))
+            if next_frame_time is None or frame_time + frame_delay < next_frame_time:
+                next_frame_time = frame_time + frame_delay
 
             # Getting esc key
-            stdscr.timeout(500)
-            key = stdscr.getch()
+            key = self.wait_for_event(stdscr, selector, next_frame_time - time.perf_counter())
             if key == 27:
                 stdscr.nodelay(True)
                 key = stdscr.getch()
@@ -835,11 +4045,152 @@ class Application:
                     self.is_running = False
             elif key == ord('q'):
                 self.is_running = False
+            elif key == curses.KEY_RESIZE:
+                # Curses has resized the screen, the new layout is made on the next frame
+                pass
+            elif key is not None:
+                self.scroll_by_key(key, body_height, total_lines)
 
-            time_counter += 1
+            is_tick = key == -1
+            if is_tick:
+                time_counter += 1
+
+        if selector is not None:
+            self.stop_event_loop(selector, previous_handlers)
 
         return 0
 
+    def start_event_loop(self):
+        """
+        Start waiting for keys, new snapshots and signals in the main loop. Signals
+        (SIGINT, SIGTERM, SIGWINCH) and published snapshots write to the wakeup pipe.
+        Must be called from the main thread, after curses is initialized.
+        :return: (selectors.DefaultSelector, (previous wakeup fd, previous SIGWINCH handler))
+        """
+        import selectors
+        selector = selectors.DefaultSelector()
+        selector.register(sys.stdin, selectors.EVENT_READ)
+        selector.register(self.wakeup_pipe[0], selectors.EVENT_READ)
+        wakeup_fd = signal.set_wakeup_fd(self.wakeup_pipe[1])
+        # Replaces SIGWINCH handler of curses, the screen is resized by resize_terminal
+        sigwinch_handler = signal.signal(signal.SIGWINCH, self.sigwinch_handler)
+        return selector, (wakeup_fd, sigwinch_handler)
+
+    @staticmethod
+    def stop_event_loop(selector, previous):
+        """
+        Stop waiting for events started by start_event_loop
+        :param selector: selectors.DefaultSelector
+        :param previous: (wakeup fd, SIGWINCH handler) replaced by start_event_loop
+        :return: nothing
+        """
+        wakeup_fd, sigwinch_handler = previous
+        # Handler installed by curses itself is not a Python object, it can't be restored
+        signal.signal(signal.SIGWINCH,
+                      signal.SIG_DFL if sigwinch_handler is None else sigwinch_handler)
+        signal.set_wakeup_fd(wakeup_fd)
+        selector.close()
+
+    def wait_for_event(self, stdscr, selector, delay):
+        """
+        Wait for a key, a new snapshot or a signal, but not longer than delay
+        :param stdscr: curses screen
+        :param selector: selectors.DefaultSelector from start_event_loop, None to wait
+                         for keys only
+        :param delay: maximum time to wait, seconds
+        :return: key code, -1 if nothing happened, None if woken up by a snapshot or signal
+        """
+        if selector is None:
+            stdscr.timeout(max(0, int(delay * 1000 + 0.999)))
+            return stdscr.getch()
+
+        # Curses may already have keys read from the terminal
+        stdscr.nodelay(True)
+        key = stdscr.getch()
+        if key != -1:
+            return key
+
+        woken = False
+        for selector_key, _ in selector.select(max(0, delay)):
+            if selector_key.fileobj == self.wakeup_pipe[0]:
+                woken = True
+                try:
+                    while os.read(self.wakeup_pipe[0], 4096):
+                        pass
+                except OSError:
+                    pass
+
+        key = stdscr.getch()
+        if key == -1 and woken:
+            return None
+        return key
+
+    @staticmethod
+    def resize_terminal():
+        """
+        Resize curses screen to the current terminal size, after SIGWINCH
+        :return: nothing
+        """
+        import curses
+        try:
+            size = os.get_terminal_size(sys.__stdout__.fileno())
+            curses.resizeterm(size.lines, size.columns)
+        except:
+            pass
+
+    def draw_stop_lines(self, frame, snapshot, start_line, body_height, time_counter):
+        """
+        Draw visible lines of the stop body (route type headers and routes)
+        :param frame: curses screen (FrameBuffer)
+        :param snapshot: StopSnapshot
+        :param start_line: line of the whole timetable where the stop body starts
+        :param body_height: number of screen lines available for the timetable
+        :param time_counter: current time counter
+        :return: nothing
+        """
+        lines = snapshot.view.lines
+        first = max(0, self.scroll - start_line)
+        last = min(len(lines), self.scroll + body_height - start_line)
+        if first >= last:
+            return
+        yandex_now = snapshot.yandex_now()
+
+        for i in range(first, last):
+            kind, item = lines[i]
+            screen_line = start_line + i - self.scroll
+            if kind == StopView.LINE_ROUTE:
+                self.draw_transport_data(frame, screen_line, item, yandex_now, time_counter)
+            elif kind == StopView.LINE_ROUTE_TYPE:
+                self.draw_route_type_header(frame, screen_line, item)
+            elif kind == StopView.LINE_COLUMNS and i == first:
+                # Route type header is scrolled away, only its second line is visible
+                self.draw_route_type_header(frame, screen_line - 1, item)
+
+    def scroll_by_key(self, key, body_height, total_lines):
+        """
+        Scroll the timetable if a scrolling key was pressed
+        :param key: key code from getch()
+        :param body_height: number of screen lines available for the timetable
+        :param total_lines: number of lines in the whole timetable
+        :return: nothing
+        """
+        import curses
+        if key == curses.KEY_UP:
+            self.scroll -= 1
+        elif key == curses.KEY_DOWN:
+            self.scroll += 1
+        elif key == curses.KEY_PPAGE:
+            self.scroll -= max(1, body_height - 1)
+        elif key in (curses.KEY_NPAGE, ord(' ')):
+            self.scroll += max(1, body_height - 1)
+        elif key == curses.KEY_HOME:
+            self.scroll = 0
+        elif key == curses.KEY_END:
+            self.scroll = total_lines
+        else:
+            return
+        self.scroll = max(0, min(self.scroll, total_lines - body_height))
+
     def parse_arguments(self):
         """
         Parses CLI arguments
@@ -849,12 +4200,14 @@ class Application:
                                          "Yandex Transport Timetable in your terminal.\n" +
                                          "Requires UNICODE (UTF-8) support, plus launched and\n"
                                          "accessible Yandex Transport Proxy server.\n"
-                                         "See: https://github.com/OwlSoul/YandexTransportProxy",
+                                         "See: https://github.com/OwlSoul/YandexTransportProxy\n"
+                                         "Run '%(prog)s analyze --help' for analytics\n"
+                                         "of the log_dir archive.",
                                          formatter_class=argparse.RawTextHelpFormatter)
         parser.add_argument("-V", "--version", action="store_true", default=False,
                             help="show version info")
-        parser.add_argument("source_url", default="", nargs='?',
-                            help="source URL, can be one of these: \n"
+        parser.add_argument("source_url", default=[], nargs='*',
+                            help="source URLs (one or more), can be one of these: \n"
                                  "  Yandex Maps URL, like \n"
                                  "  https://yandex.ru/maps/?masstransit[stopId]=stop__9680781\n"
                                  "  Yandex Stop ID, like stopid:stop__9680781\n"
@@ -863,51 +4216,271 @@ class Application:
         parser.add_argument("--proxy-host", metavar="HOST", default=self.proxy_host,
                             help="host of the Yandex Transport Proxy server,\n"
                                  "default is " + str(self.proxy_host))
-        parser.add_argument("--proxy-port", metavar="PORT", default=self.proxy_port,
+        parser.add_argument("--proxy-port", metavar="PORT", type=int, default=self.proxy_port,
                             help="port of the Yandex Transport Proxy server,\n"
                                  "default is " + str(self.proxy_port))
-        parser.add_argument("--wait_time", metavar="TIME", default=self.wait_time,
+        parser.add_argument("--wait_time", metavar="TIME", type=int, default=self.wait_time,
                             help="wait time in secs between queries, default is " +
-                            str(self.wait_time))
-        parser.add_argument("--timeout", metavar="TIME", default=self.timeout,
+                            str(self.wait_time) + ",\n"
+                            "less when a vehicle is about to arrive, more at night\n"
+                            "and after errors")
+        parser.add_argument("--fixed_wait_time", action="store_true", default=False,
+                            help="always wait exactly wait_time between queries")
+        parser.add_argument("--timeout", metavar="TIME", type=int, default=self.timeout,
                             help="timeout for waiting in secs , default is " + str(self.timeout))
+        parser.add_argument("--max_workers", metavar="NUM", type=int, default=self.max_workers,
+                            help="maximum number of simultaneous queries to the proxy server,\n"
+                                 "default is " + str(self.max_workers))
+        parser.add_argument("--rate", metavar="RATE", type=float, default=self.rate,
+                            help="maximum queries per second to the proxy server,\n"
+                                 "0 for no limit, default is " + str(self.rate))
+        parser.add_argument("--burst", metavar="NUM", type=int, default=self.burst,
+                            help="maximum queries to the proxy server at once before\n"
+                                 "the rate limit starts, default is " + str(self.burst))
         parser.add_argument("--log_dir", metavar="DIR", default=self.log_dir,
                             help="directory to store data from Yandex in JSON format, \n"
                                  "omitted by default (no logs)")
+        parser.add_argument("--log_max_size", metavar="MB", type=int, default=self.log_max_size,
+                            help="start new log_dir segment file after this size, \n"
+                                 "default is " + str(self.log_max_size) + " MB")
+        parser.add_argument("--log_rotate_time", metavar="TIME", type=int,
+                            default=self.log_rotate_time,
+                            help="start new log_dir segment file after this time in secs, \n"
+                                 "default is " + str(self.log_rotate_time))
+        parser.add_argument("--log_raw", action="store_true", default=False,
+                            help="store data to log_dir exactly as received, by default\n"
+                                 "only the fields used by this program are stored")
+        parser.add_argument("--cache", metavar="ADDRESS", default=self.cache_address,
+                            help="get data from the local cache server instead of\n"
+                                 "the proxy server, ADDRESS is HOST:PORT or unix:PATH")
+        parser.add_argument("--serve", metavar="ADDRESS", default=self.serve_address,
+                            help="run as local cache server for other timetables at ADDRESS,\n"
+                                 "HOST:PORT or unix:PATH, no screen in this mode")
+        parser.add_argument("--cache_ttl", metavar="TIME", type=int, default=self.cache_ttl,
+                            help="how long the cache server keeps data of the stops\n"
+                                 "nobody is subscribed to, default is " + str(self.cache_ttl))
+        parser.add_argument("--auto_page", metavar="TIME", type=int, default=self.auto_page,
+                            help="show next page of the timetable every TIME secs,\n"
+                                 "for unattended boards, default is 0 (switched off)")
+        parser.add_argument("--warm_cache", metavar="FILE", default=self.warm_cache_file,
+                            help="keep the last good data of every stop in FILE and show it\n"
+                                 "at start (marked as stale) till fresh data arrives")
+        parser.add_argument("--show_metrics", action="store_true", default=False,
+                            help="show polling and rendering metrics above the footer")
+        parser.add_argument("--metrics_file", metavar="FILE", default=self.metrics_file,
+                            help="write metrics to this Prometheus textfile every " +
+                            str(MetricsExporter.FILE_INTERVAL) + " secs")
+        parser.add_argument("--metrics_address", metavar="ADDRESS", default=self.metrics_address,
+                            help="serve metrics over HTTP at ADDRESS/metrics,\n"
+                                 "PORT (localhost), HOST:PORT or unix:PATH")
+        parser.add_argument("--headless", action="store_true", default=False,
+                            help="no curses screen, write data as JSON lines (one line\n"
+                                 "per stop each time its data changes) to the output instead")
+        parser.add_argument("--output", metavar="FILE", default=self.output,
+                            help="output file or FIFO for headless mode, \n"
+                                 "default is '-' (standard output)")
+        parser.add_argument("--replay", metavar="DIR", default=self.replay_dir,
+                            help="replay data from log_dir archive instead of querying\n"
+                                 "the proxy server, source URLs are optional in this case")
+        parser.add_argument("--replay_speed", metavar="SPEED", type=float,
+                            default=self.replay_speed,
+                            help="replay speed, 60 means one hour in a minute,\n"
+                                 "0 means as fast as possible, default is " +
+                            str(self.replay_speed))
+        parser.add_argument("--replay_from", metavar="TIME", default=None,
+                            help="start replay from this time, 'YYYY-MM-DD HH:MM:SS'\n"
+                                 "(local time) or unix timestamp")
 
         args = parser.parse_args()
         if args.version:
             print(__version__)
             sys.exit(0)
 
+        self.auto_page = args.auto_page
+        self.show_metrics = args.show_metrics
+        self.warm_cache_file = args.warm_cache
+        self.metrics_file = args.metrics_file
+        self.metrics_address = args.metrics_address
+        self.headless = args.headless
+        self.output = args.output
+        if self.headless and self.output == '-':
+            # Standard output is for data only, all messages go to standard error
+            self.output_stream = sys.stdout
+            sys.stdout = sys.stderr
+
         self.proxy_host = args.proxy_host
         self.proxy_port = args.proxy_port
         self.wait_time = args.wait_time
+        self.adaptive_polling = not args.fixed_wait_time
         self.timeout = args.timeout
+        self.max_workers = args.max_workers
+        self.rate = args.rate
+        self.burst = args.burst
         self.log_dir = args.log_dir
-
-        # Parsing the Source URL
-        if args.source_url.startswith("http://") or args.source_url.startswith("https://"):
-            self.source_url = args.source_url
-            self.data_source = self.DATA_SOURCE_API
-        elif args.source_url.startswith("stopid:"):
-            self.source_url = "https://yandex.ru/maps/?masstransit[stopId]="+args.source_url[7:]
-            print(self.source_url)
-            self.data_source = self.DATA_SOURCE_API
-        elif args.source_url:                         # if len(args.source_url) > 0
-            self.source_url = args.source_url
-            self.data_source = self.DATA_SOURCE_FILE
-        else:
+        self.log_max_size = args.log_max_size
+        self.log_rotate_time = args.log_rotate_time
+        self.log_raw = args.log_raw
+        self.replay_dir = args.replay
+        self.replay_speed = args.replay_speed
+        if args.replay_from is not None:
+            self.replay_from = parse_time(args.replay_from)
+            if self.replay_from is None:
+                print("Wrong replay start time:", args.replay_from)
+                sys.exit(1)
+
+        self.cache_address = args.cache
+        self.serve_address = args.serve
+        self.cache_ttl = args.cache_ttl
+        for option, address in (("--cache", self.cache_address),
+                                ("--serve", self.serve_address),
+                                ("--metrics_address", self.metrics_address)):
+            if address == '':
+                continue
+            try:
+                family, path = parse_address(address)
+                if family == socket.AF_UNIX and option != "--cache":
+                    check_socket_path(path)
+            except ValueError as e:
+                print("Wrong address for " + option + ":", address, "-", e)
+                sys.exit(1)
+
+        if self.serve_address != '':
+            # Stops are requested by the clients
+            return
+        if self.replay_dir != '':
+            self.replay_filter = bool(args.source_url)
+        elif not args.source_url:
             print("No source URL, station id or filename provided!")
             sys.exit(0)
 
-        print("Source URL:", self.source_url)
+        # Parsing the Source URLs
+        for source_url in args.source_url:
+            if source_url.startswith("http://") or source_url.startswith("https://"):
+                data_source = self.DATA_SOURCE_API
+            elif source_url.startswith("stopid:"):
+                source_url = "https://yandex.ru/maps/?masstransit[stopId]="+source_url[7:]
+                print(source_url)
+                data_source = self.DATA_SOURCE_API
+            else:
+                data_source = self.DATA_SOURCE_FILE
+            if data_source == self.DATA_SOURCE_API and self.cache_address != '':
+                data_source = self.DATA_SOURCE_CACHE
+            self.stops.append(StopState(len(self.stops), source_url, data_source))
+            print("Source URL:", source_url)
+
+    def analyze(self, argv):
+        """
+        Run "analyze" subcommand: offline analytics over the log_dir archive
+        :param argv: command line arguments after "analyze"
+        :return: nothing
+        """
+        parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + " analyze",
+                                         description=
+                                         "Headways, gaps against announced frequency and\n"
+                                         "availability of service per route and hour,\n"
+                                         "from the log_dir archive. Requires NumPy.",
+                                         formatter_class=argparse.RawTextHelpFormatter)
+        parser.add_argument("log_dir", metavar="DIR",
+                            help="log_dir archive to analyze")
+        parser.add_argument("source_url", default=[], nargs='*',
+                            help="stops to analyze (Yandex Maps URLs or stop IDs),\n"
+                                 "default is all stops in the archive")
+        parser.add_argument("--from", dest="begin", metavar="TIME", default=None,
+                            help="analyze records from this time, 'YYYY-MM-DD HH:MM:SS'\n"
+                                 "(local time) or unix timestamp")
+        parser.add_argument("--to", dest="end", metavar="TIME", default=None,
+                            help="analyze records till this time, same format as --from")
+        parser.add_argument("--workers", metavar="NUM", type=int, default=os.cpu_count() or 1,
+                            help="processes reading the archive, default is number of CPUs")
+        parser.add_argument("--json", action="store_true", default=False,
+                            help="print results as JSON, times in seconds")
+        args = parser.parse_args(argv)
+        if not os.path.isdir(args.log_dir):
+            print("No such directory:", args.log_dir)
+            sys.exit(1)
+
+        numpy = import_optional('numpy')
+        if numpy is None:
+            print("NumPy is required for analyze: pip3 install numpy")
+            sys.exit(1)
+
+        times = []
+        for text in (args.begin, args.end):
+            timestamp = None
+            if text is not None:
+                timestamp = parse_time(text)
+                if timestamp is None:
+                    print("Wrong time:", text)
+                    sys.exit(1)
+            times.append(timestamp)
+
+        stops = set()
+        for source_url in args.source_url:
+            if source_url.startswith("stopid:"):
+                source_url = "https://yandex.ru/maps/?masstransit[stopId]=" + source_url[7:]
+            stops.add(source_url)
+
+        analyzer = ArchiveAnalyzer(numpy)
+        start = time.monotonic()
+        records = analyzer.load(ArchiveReader(args.log_dir),
+                                times[0], times[1], stops or None, args.workers)
+        load_time = time.monotonic() - start
+        report = analyzer.report()
+        print("ANALYZED {} RECORDS, LOADED IN {:.2f} S, COMPUTED IN {:.2f} S".format(
+            records, load_time, time.monotonic() - start - load_time), file=sys.stderr)
+
+        if args.json:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            self.print_analysis(report)
+
+    @staticmethod
+    def print_analysis(report):
+        """
+        Print results of the analysis as tables
+        :param report: ArchiveAnalyzer.report() result
+        :return: nothing
+        """
+        def minutes(seconds):
+            if seconds is None:
+                return "-"
+            return "{:.1f}".format(seconds / 60)
+
+        for stop in report:
+            print("STOP:", stop['name'], "(" + stop['stop'] + ")")
+            print("SNAPSHOTS:", stop['snapshots'], "FROM",
+                  datetime.datetime.fromtimestamp(stop['begin']).strftime('%Y-%m-%d %H:%M:%S'),
+                  "TO", datetime.datetime.fromtimestamp(stop['end']).strftime('%Y-%m-%d %H:%M:%S'))
+            print()
+            print("HEADWAYS, MINUTES")
+            print("{:<12} {:<12} {:>8} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6}".format(
+                "ROUTE", "TYPE", "ARRIVALS", "MEAN", "P10", "P50", "P90", "FREQ", "GAPS", "EXCESS"))
+            for route in stop['routes']:
+                print("{:<12} {:<12} {:>8} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6}".format(
+                    route['name'][:12], route['type'][:12], route['arrivals'],
+                    minutes(route.get('mean')), minutes(route.get('p10')),
+                    minutes(route.get('p50')), minutes(route.get('p90')),
+                    minutes(route['frequency']), route.get('gaps', "-"),
+                    minutes(route.get('excess'))))
+            print()
+            print("AVAILABILITY, % OF SNAPSHOTS WITH VEHICLES ON THE WAY, BY HOUR")
+            print("{:<12}".format("ROUTE") + "".join("{:>4}".format(hour) for hour in range(24)))
+            for route in stop['routes']:
+                print("{:<12}".format(route['name'][:12]) +
+                      "".join("{:>4}".format("." if share is None else int(round(share * 100)))
+                              for share in route['availability']))
+            print()
 
     def run(self):
         """
         Run the main program
         :return: nothing
         """
+        # Offline analytics of the log_dir archive, nothing else is started
+        if sys.argv[1:2] == ['analyze']:
+            self.analyze(sys.argv[2:])
+            return
+
         # Setting SIGINT and SIGTERM handlers
         signal.signal(signal.SIGINT, self.sigint_handler)
         signal.signal(signal.SIGTERM, self.sigint_handler)
@@ -915,20 +4488,90 @@ class Application:
         # Parsing CLI Arguments
         self.parse_arguments()
 
-        # Launch separate thread for periodical polling of data from
-        # Yandex Transport Proxy
+        # Following vehicles before anybody shows the snapshots
+        self.vehicle_tracker = VehicleTracker(self.metrics)
+        self.snapshot_listeners.append(self.vehicle_tracker)
+
+        # Headless mode output
+        if self.headless:
+            if self.output_stream is None:
+                # Opening a FIFO waits here till somebody opens it for reading
+                self.output_stream = open(self.output, 'w', encoding='utf-8')
+            self.snapshot_listeners.append(HeadlessWriter(self, self.output_stream))
+
+        # Showing the last known data right away, the replay has its own data
+        if self.warm_cache_file != '' and self.replay_dir == '':
+            self.warm_cache = WarmCache(self, self.warm_cache_file)
+            print("WARM START:", self.warm_cache.load(), "STOPS RESTORED")
+            self.snapshot_listeners.append(self.warm_cache)
+
+        # Launch separate thread for exporting metrics
+        if self.metrics_file != '' or self.metrics_address != '':
+            self.metrics_exporter = MetricsExporter(self, self.metrics_file, self.metrics_address)
+            self.metrics_exporter.start()
+
+        # Launch separate thread for storing data to log_dir
+        if self.log_dir != '':
+            self.archive_writer = ArchiveWriter(self.log_dir,
+                                                self.log_max_size * 1024 * 1024,
+                                                self.log_rotate_time,
+                                                self.ARCHIVE_QUEUE_SIZE,
+                                                self.metrics)
+            self.archive_writer.start()
 
-        self.executor_thread = ExecutorThread(self, self.proxy_host, self.proxy_port)
+        # Launch separate thread for periodical polling of data from
+        # Yandex Transport Proxy (or replaying the archive)
+        if self.replay_dir != '':
+            self.executor_thread = ReplayThread(self, self.replay_dir,
+                                                self.replay_speed, self.replay_from)
+        else:
+            self.executor_thread = ExecutorThread(self, self.proxy_host, self.proxy_port,
+                                                  self.max_workers)
         print("STARTING EXECUTOR THREAD...")
         self.executor_thread.start()
 
-        # Main wrapper function for curses window
-        print("STARTING MAIN WINDOW...")
-        wrapper(self.main)
+        if any(stop.data_source == self.DATA_SOURCE_CACHE for stop in self.stops):
+            self.cache_client = CacheClientThread(self, self.cache_address)
+            self.cache_client.start()
+
+        if self.serve_address != '':
+            self.cache_server = CacheServer(self, self.serve_address, self.cache_ttl)
+            self.snapshot_listeners.append(self.cache_server)
+            self.cache_server.start()
+            print("CACHE SERVER STARTED AT", self.serve_address)
+            while self.is_running:
+                time.sleep(0.5)
+                self.cache_server.expire()
+            self.cache_server.stop()
+        elif self.headless:
+            while self.is_running:
+                time.sleep(0.5)
+        else:
+            # Main wrapper function for curses window
+            import curses
+            print("STARTING MAIN WINDOW...")
+            self.wakeup_pipe = os.pipe()
+            for fd in self.wakeup_pipe:
+                os.set_blocking(fd, False)
+            self.screen_active = True
+            try:
+                curses.wrapper(self.main)
+            finally:
+                self.screen_active = False
 
         # Waiting for executor thread to complete
         print("WAITING FOR EXECUTOR THREAD TO COMPLETE...")
         self.executor_thread.join()
+        if self.cache_client is not None:
+            self.cache_client.join()
+        if self.archive_writer is not None:
+            print("WAITING FOR ARCHIVE WRITER TO COMPLETE...")
+            self.archive_writer.stop()
+            self.archive_writer.join()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.join()
+        if self.warm_cache is not None:
+            self.warm_cache.save()
         print("APPLICATION TERMINATED")
 
 if __name__ == '__main__':